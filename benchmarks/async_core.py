@@ -0,0 +1,222 @@
+"""
+Benchmark the sustained throughput of the asyncio processing core against the run_async
+thread model, where each update takes a dispatcher worker for its whole duration.
+
+Each update makes the calls of a link check, simulated with a fixed round trip time:
+the admin check, the typing action and the URL probes, the Safe Browsing lookup, and
+the reply. The thread model blocks a worker on each call, while the core awaits them
+without holding a thread of its lane. Updates arrive from a few busy chats and many
+quiet ones. For each model, report the updates per second and the mean and 95th
+percentile latency. The thread model is run with the default dispatcher workers, and
+with as many workers as the threads of the moderation lane that the core processes
+these updates in, so that both models are compared at the same number of threads.
+
+Then flood the moderation lane with the same link checks while undo and delete button
+callbacks arrive alongside them, and report the latency of the callbacks when they
+share the moderation lane against when they have the interactive lane to themselves.
+
+Button callbacks still make their calls on the threads of their lane. Last, have one
+chat raid the moderation lane with half of the updates, and report the latency of the
+raiding and the other chats with and without the fallback to cheap checks, where a
+cheap check makes a single call.
+
+    python benchmarks/async_core.py --updates 2000 --rtt 0.05
+"""
+import argparse
+import asyncio
+import functools
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from group_defender.constants import (
+    CORE_CHAT_QUEUE,
+    CORE_CHAT_UPDATES,
+    CORE_LANES,
+    INTERACTIVE,
+    MODERATION,
+)
+from group_defender.core import AsyncCore, cheap_checks, run_blocking
+
+NUM_CHATS = 200
+BUSY_CHATS = 5  # Chats that send half of the updates
+CALLBACK_EVERY = 20  # A button callback arrives with every 20 link checks
+
+
+def blocking_call(rtt):
+    time.sleep(rtt)
+
+
+async def awaited_call(rtt):
+    await asyncio.sleep(rtt)
+
+
+def handle_sync(rtt):
+    blocking_call(rtt)  # Admin check
+    blocking_call(rtt)  # Typing action
+    blocking_call(rtt)  # URL probes
+    blocking_call(rtt)  # Safe Browsing lookup
+    blocking_call(rtt)  # Reply
+
+
+async def handle_async(rtt):
+    await awaited_call(rtt)  # Admin check
+    await asyncio.gather(awaited_call(rtt), awaited_call(rtt))  # Typing and probes
+    await awaited_call(rtt)  # Safe Browsing lookup
+    await awaited_call(rtt)  # Reply
+
+
+async def handle_callback(rtt):
+    await run_blocking(blocking_call, rtt)  # Answer the query
+    await run_blocking(blocking_call, rtt)  # Delete or restore the message
+
+
+def pick_chat():
+    if random.random() < 0.5:
+        return random.randrange(BUSY_CHATS)
+
+    return random.randrange(BUSY_CHATS, NUM_CHATS)
+
+
+def run_threads(workers, num_updates, rtt):
+    executor = ThreadPoolExecutor(max_workers=workers)
+    latencies = []
+    lock = threading.Lock()
+
+    def handle(arrival):
+        handle_sync(rtt)
+        with lock:
+            latencies.append(time.perf_counter() - arrival)
+
+    start = time.perf_counter()
+    for _ in range(num_updates):
+        executor.submit(handle, time.perf_counter())
+
+    executor.shutdown(wait=True)
+
+    return summarize(latencies, num_updates, time.perf_counter() - start)
+
+
+def run_core(num_updates, rtt):
+    core = AsyncCore(CORE_LANES, CORE_CHAT_UPDATES, CORE_CHAT_QUEUE)
+    latencies = []
+
+    async def handle(arrival):
+        await handle_async(rtt)
+        latencies.append(time.perf_counter() - arrival)
+
+    start = time.perf_counter()
+    futures = [
+        core.submit(MODERATION, pick_chat(), handle(time.perf_counter()))
+        for _ in range(num_updates)
+    ]
+
+    for future in futures:
+        future.result()
+
+    return summarize(latencies, num_updates, time.perf_counter() - start)
+
+
+def run_flood(callback_lane, num_updates, rtt):
+    core = AsyncCore(CORE_LANES, CORE_CHAT_UPDATES, CORE_CHAT_QUEUE)
+    latencies = []
+
+    async def handle(arrival):
+        await handle_callback(rtt)
+        latencies.append(time.perf_counter() - arrival)
+
+    start = time.perf_counter()
+    futures = []
+    for i in range(num_updates):
+        futures.append(core.submit(MODERATION, pick_chat(), handle_async(rtt)))
+        if i % CALLBACK_EVERY == 0:
+            futures.append(
+                core.submit(callback_lane, pick_chat(), handle(time.perf_counter()))
+            )
+
+    for future in futures:
+        future.result()
+
+    return summarize(latencies, len(latencies), time.perf_counter() - start)
+
+
+def run_raid(chat_queue, num_updates, rtt):
+    core = AsyncCore(CORE_LANES, CORE_CHAT_UPDATES, chat_queue)
+    latencies = {True: [], False: []}
+
+    async def handle(raid, arrival):
+        if cheap_checks.get():
+            await awaited_call(rtt)
+        else:
+            await handle_async(rtt)
+
+        latencies[raid].append(time.perf_counter() - arrival)
+
+    futures = []
+    for i in range(num_updates):
+        raid = i % 2 == 0
+        chat_id = -1 if raid else random.randrange(NUM_CHATS)
+        futures.append(
+            core.submit(MODERATION, chat_id, handle(raid, time.perf_counter()))
+        )
+
+    for future in futures:
+        future.result()
+
+    return [summarize(latencies[x], len(latencies[x]), 1)[1:] for x in (True, False)]
+
+
+def summarize(latencies, num_updates, elapsed):
+    latencies.sort()
+
+    return (
+        num_updates / elapsed,
+        statistics.mean(latencies) * 1000,
+        latencies[int(len(latencies) * 0.95)] * 1000,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--rtt", type=float, default=0.05, help="seconds per call")
+    parser.add_argument(
+        "--workers", type=int, default=4, help="dispatcher workers of the threads"
+    )
+    args = parser.parse_args()
+
+    lane_threads = CORE_LANES[MODERATION][1]
+    models = (
+        (f"threads({args.workers})", functools.partial(run_threads, args.workers)),
+        (f"threads({lane_threads})", functools.partial(run_threads, lane_threads)),
+        ("core", run_core),
+    )
+
+    print(f"{'model':>12} {'updates/s':>10} {'mean ms':>9} {'p95 ms':>9}")
+    for label, run in models:
+        throughput, mean, p95 = run(args.updates, args.rtt)
+        print(f"{label:>12} {throughput:>10.1f} {mean:>9.1f} {p95:>9.1f}")
+
+    print(f"\n{'callbacks':>12} {'mean ms':>9} {'p95 ms':>9}")
+    for label, lane in (("shared lane", MODERATION), ("own lane", INTERACTIVE)):
+        _, mean, p95 = run_flood(lane, args.updates, args.rtt)
+        print(f"{label:>12} {mean:>9.1f} {p95:>9.1f}")
+
+    print(f"\n{'raid':>12} {'raider p95':>11} {'others p95':>11}")
+    for label, chat_queue in (
+        ("no fallback", args.updates),
+        ("fallback", CORE_CHAT_QUEUE),
+    ):
+        (_, raider), (_, others) = run_raid(chat_queue, args.updates, args.rtt)
+        print(f"{label:>12} {raider:>11.1f} {others:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark the tradeoff between the micro-batching window of Safe Browsing lookups
+and the number of lookup requests.
+
+Messages with links arrive at a steady rate from concurrent handlers, and each lookup
+request is simulated with a fixed round trip time. For each window size, report the
+number of requests sent, the mean and 95th percentile lookup latency seen by handlers,
+and the throughput in messages per second.
+
+    python benchmarks/batch_window.py --rate 200 --messages 2000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from group_defender.batch import MicroBatcher
+
+WINDOWS = [0, 0.01, 0.025, 0.05, 0.1, 0.2]
+
+
+def run(window, rate, num_messages, rtt):
+    num_requests = 0
+    lock = threading.Lock()
+
+    def lookup(urls):
+        nonlocal num_requests
+        with lock:
+            num_requests += 1
+
+        time.sleep(rtt)
+
+        return [True] * len(urls)
+
+    if window is None:
+        submit = lookup
+    else:
+        submit = MicroBatcher(lookup, window, 500).submit
+
+    latencies = []
+
+    def handle(urls):
+        start = time.perf_counter()
+        submit(urls)
+        latencies.append(time.perf_counter() - start)
+
+    threads = []
+    start = time.perf_counter()
+
+    for i in range(num_messages):
+        urls = [f"http://example{i}.com/{j}" for j in range(random.randint(1, 3))]
+        thread = threading.Thread(target=handle, args=(urls,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(random.expovariate(rate))
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    return (
+        num_requests,
+        statistics.mean(latencies) * 1000,
+        latencies[int(len(latencies) * 0.95)] * 1000,
+        num_messages / elapsed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rate", type=float, default=200, help="messages per second")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rtt", type=float, default=0.08, help="seconds per request")
+    args = parser.parse_args()
+
+    print(f"{'window':>10} {'requests':>9} {'mean ms':>8} {'p95 ms':>8} {'msg/s':>8}")
+    for window in [None] + WINDOWS:
+        requests, mean, p95, throughput = run(
+            window, args.rate, args.messages, args.rtt
+        )
+        label = "unbatched" if window is None else f"{window * 1000:g}ms"
+        print(f"{label:>10} {requests:>9} {mean:>8.1f} {p95:>8.1f} {throughput:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark the time to import the bot package with the heavy dependencies loaded lazily,
+against loading all of them up front as the package used to do.
+
+Each import runs in a fresh interpreter, so nothing is cached in the process. Report
+the mean and minimum time of both, and how long each lazily loaded module takes to
+import after the package.
+
+    python benchmarks/import_time.py --runs 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAZY = "import group_defender"
+EAGER = """
+import group_defender
+from group_defender.lazy import lazy_modules
+
+for module in lazy_modules.values():
+    module.load()
+"""
+TIMER = """
+import time
+
+start = time.perf_counter()
+{code}
+print(time.perf_counter() - start)
+"""
+BREAKDOWN = """
+import time
+import group_defender
+from group_defender.lazy import lazy_modules
+
+for name, module in lazy_modules.items():
+    start = time.perf_counter()
+    module.load()
+    print(name, time.perf_counter() - start)
+"""
+
+
+def run_python(code):
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=ROOT,
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+
+    return result.stdout.splitlines()
+
+
+def time_import(code, runs):
+    times = [float(run_python(TIMER.format(code=code))[-1]) for _ in range(runs)]
+
+    return statistics.mean(times) * 1000, min(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'import':>10} {'mean ms':>8} {'min ms':>8}")
+    for label, code in (("lazy", LAZY), ("eager", EAGER)):
+        mean, fastest = time_import(code, args.runs)
+        print(f"{label:>10} {mean:>8.1f} {fastest:>8.1f}")
+
+    print()
+    for line in run_python(BREAKDOWN):
+        name, elapsed = line.rsplit(" ", 1)
+        print(f"{name:>48} {float(elapsed) * 1000:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
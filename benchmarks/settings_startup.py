@@ -0,0 +1,89 @@
+"""
+Benchmark loading the settings at startup, one storage call per setting as each module
+used to do at import time against the single batched call of the settings loader.
+
+Each storage call is simulated with a fixed round trip time on top of a temporary
+SQLite database, or made against the configured storage backend with --live. For each
+approach, report the number of storage calls and the mean and worst time taken to have
+every setting available.
+
+    python benchmarks/settings_startup.py --rtt 0.03 --runs 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Use a temporary SQLite database unless running against the configured backend
+if "--live" not in sys.argv:
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    os.environ["SQLITE_DB"] = os.path.join(tempfile.gettempdir(), "settings_bench.db")
+
+from group_defender import settings
+from group_defender.storage import storage
+
+
+class DelayedStorage:
+    def __init__(self, backend, rtt):
+        self.backend = backend
+        self.rtt = rtt
+        self.num_calls = 0
+
+    def get_settings(self, names):
+        self.num_calls += 1
+        time.sleep(self.rtt)
+
+        return self.backend.get_settings(names)
+
+
+def load_serial(backend):
+    for name in settings.SETTINGS:
+        backend.get_settings([name])
+
+
+def load_batched(backend):
+    settings.storage = backend
+    settings.load_time = None
+
+    for name in settings.SETTINGS:
+        settings.get_setting(name)
+
+
+def run(load, backend, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        load(backend)
+        times.append(time.perf_counter() - start)
+
+    return backend.num_calls // runs, statistics.mean(times) * 1000, max(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rtt", type=float, default=0.03, help="seconds per call")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument(
+        "--live", action="store_true", help="use the configured storage backend"
+    )
+    args = parser.parse_args()
+
+    # Make every setting come from the storage
+    for env_names in settings.SETTINGS.values():
+        for env_name in env_names:
+            os.environ.pop(env_name, None)
+
+    rtt = 0 if args.live else args.rtt
+    print(f"{'loading':>10} {'calls':>6} {'mean ms':>8} {'max ms':>8}")
+
+    for label, load in (("serial", load_serial), ("batched", load_batched)):
+        calls, mean, worst = run(load, DelayedStorage(storage, rtt), args.runs)
+        print(f"{label:>10} {calls:>6} {mean:>8.1f} {worst:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
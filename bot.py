@@ -1,3 +1,4 @@
+import asyncio
 import logbook
 import os
 import re
@@ -7,16 +8,22 @@ from dotenv import load_dotenv
 from datetime import timedelta
 from logbook import Logger, StreamHandler
 from logbook.compat import redirect_logging
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity, Chat
+from telegram import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    MessageEntity,
+    Chat,
+    Update,
+)
 from telegram.ext import (
     Updater,
+    ChatMemberHandler,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     Filters,
     PreCheckoutQueryHandler,
 )
-from telegram.ext.dispatcher import run_async
 from telegram.parsemode import ParseMode
 
 from group_defender import *
@@ -24,12 +31,9 @@ from group_defender import *
 load_dotenv()
 APP_URL = os.environ.get("APP_URL")
 PORT = int(os.environ.get("PORT", "8443"))
-TELE_TOKEN = os.environ.get("TELE_TOKEN_BETA", os.environ.get("TELE_TOKEN"))
-DEV_TELE_ID = int(os.environ.get("DEV_TELE_ID", 0))
 PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT")
 
 if PROJECT_ID is not None:
-    TELE_TOKEN, DEV_TELE_ID = get_settings(["TELE_TOKEN", "DEV_TELE_ID"])
     APP_URL = f"https://{PROJECT_ID}.appspot.com/"
 
 
@@ -44,17 +48,38 @@ def main():
         sys.stdout, format_string=format_string, level="INFO"
     ).push_application()
     log = Logger()
+    tele_token = get_setting("TELE_TOKEN")
+    dev_tele_id = int(get_setting("DEV_TELE_ID") or 0)
 
     # Create the EventHandler and pass it your bot's token.
     updater = Updater(
-        TELE_TOKEN,
+        tele_token,
         use_context=True,
         request_kwargs={"connect_timeout": TIMEOUT, "read_timeout": TIMEOUT},
     )
 
     # Setup job
     job_queue = updater.job_queue
-    job_queue.run_repeating(delete_expired_msg, timedelta(days=MSG_LIFETIME), 0)
+    job_queue.run_repeating(delete_expired_msg, timedelta(seconds=SWEEP_INTERVAL), 0)
+    job_queue.run_repeating(
+        reconcile_api_counts, timedelta(seconds=API_RECONCILE_INTERVAL)
+    )
+    job_queue.run_repeating(flush_stats, timedelta(seconds=STATS_FLUSH_INTERVAL))
+    job_queue.run_repeating(sweep_campaigns, timedelta(seconds=CAMPAIGN_SWEEP_INTERVAL))
+
+    if SETTINGS_REFRESH_INTERVAL is not None:
+        job_queue.run_repeating(
+            refresh_settings, timedelta(seconds=SETTINGS_REFRESH_INTERVAL)
+        )
+
+    load_phash_index()
+    job_queue.run_repeating(sync_phash_index, timedelta(seconds=PHASH_SYNC_INTERVAL))
+
+    if SAFE_BROWSING_DB is not None:
+        load_hash_prefixes()
+        job_queue.run_repeating(
+            update_hash_prefixes, timedelta(seconds=SAFE_BROWSING_UPDATE_INTERVAL), 0
+        )
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
@@ -63,9 +88,14 @@ def main():
     dispatcher.add_handler(CommandHandler("start", start_msg))
     dispatcher.add_handler(CommandHandler("help", help_msg))
     dispatcher.add_handler(CommandHandler("donate", send_payment_options))
-    dispatcher.add_handler(CommandHandler("send", send, Filters.user(DEV_TELE_ID)))
+    dispatcher.add_handler(CommandHandler("send", send, Filters.user(dev_tele_id)))
     dispatcher.add_handler(
-        CommandHandler("stats", get_stats, Filters.user(DEV_TELE_ID))
+        CommandHandler("stats", get_stats, Filters.user(dev_tele_id))
+    )
+
+    # Keep the cached chat member statuses up to date
+    dispatcher.add_handler(
+        ChatMemberHandler(update_member_status, ChatMemberHandler.ANY_CHAT_MEMBER)
     )
 
     # Callback query handler
@@ -114,18 +144,25 @@ def main():
 
     # Start the Bot
     if APP_URL is not None:
-        updater.start_webhook(listen="0.0.0.0", port=PORT, url_path=TELE_TOKEN)
-        updater.bot.set_webhook(APP_URL + TELE_TOKEN)
+        updater.start_webhook(listen="0.0.0.0", port=PORT, url_path=tele_token)
+        updater.bot.set_webhook(APP_URL + tele_token, allowed_updates=Update.ALL_TYPES)
         log.notice("Bot started webhook")
     else:
-        updater.start_polling()
+        updater.start_polling(allowed_updates=Update.ALL_TYPES)
         log.notice("Bot started polling")
 
+    # Load the dependencies of the rarer paths now that updates can be handled
+    if PREWARM_IMPORTS:
+        prewarm_modules()
+
     # Run the bot until the you presses Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
 
+    # Write the stats that are still pending after the bot has stopped
+    flush_stats()
+
 
 def start_msg(update, context):
     """
@@ -150,8 +187,8 @@ def start_msg(update, context):
     )
 
 
-@run_async
-def help_msg(update, context):
+@async_handler(INTERACTIVE)
+async def help_msg(update, context):
     """
     Send help message
     Args:
@@ -161,28 +198,33 @@ def help_msg(update, context):
     Returns:
         None
     """
-    if update.message.chat.type in (Chat.GROUP, Chat.SUPERGROUP):
-        update.message.reply_text("I've PM you the help message.")
-
     keyboard = [
         [InlineKeyboardButton("Join Channel", f"https://t.me/grpdefbotdev")],
         [InlineKeyboardButton("Support Group Defender", callback_data=PAYMENT)],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    context.bot.send_message(
-        update.message.from_user.id,
-        "If you're just chatting with me, simply send me a photo, a file or a link and "
-        "I'll tell you if it safe.\n\n"
-        "If you want me to defend your group, add me into your group and set me as an admin. "
-        "I'll filter all the unsafe content. When I removed a message, "
-        "only group admins can undo or delete the action.",
-        reply_markup=reply_markup,
-    )
+    # The reply in the group and the private message don't depend on each other
+    sends = [
+        send_message(
+            context.bot,
+            update.message.from_user.id,
+            "If you're just chatting with me, simply send me a photo, a file or a link and "
+            "I'll tell you if it safe.\n\n"
+            "If you want me to defend your group, add me into your group and set me as an admin. "
+            "I'll filter all the unsafe content. When I removed a message, "
+            "only group admins can undo or delete the action.",
+            reply_markup=reply_markup,
+        )
+    ]
+    if update.message.chat.type in (Chat.GROUP, Chat.SUPERGROUP):
+        sends.append(reply_text(update.message, "I've PM you the help message."))
+
+    await asyncio.gather(*sends)
 
 
-@run_async
-def process_callback_query(update, context):
+@async_handler(INTERACTIVE)
+async def process_callback_query(update, context):
     """
     Process callback query
     Args:
@@ -194,13 +236,13 @@ def process_callback_query(update, context):
     """
     query = update.callback_query
     if query.data == PAYMENT:
-        send_payment_options(update, context, query.from_user.id)
+        await run_blocking(send_payment_options, update, context, query.from_user.id)
     else:
-        process_msg(update, context)
+        await run_blocking(process_msg, update, context)
 
 
-@run_async
-def greet_group(update, context):
+@async_handler(INTERACTIVE)
+async def greet_group(update, context):
     """
     Send a greeting message when the bot is added into a group
     Args:
@@ -212,7 +254,8 @@ def greet_group(update, context):
     """
     for user in update.message.new_chat_members:
         if user.id == context.bot.id:
-            context.bot.send_message(
+            await send_message(
+                context.bot,
                 update.message.chat.id,
                 "Hello everyone! I am Group Defender. Set me as one of the admins so that "
                 "I can start defending your group.",
@@ -8,6 +8,10 @@ from group_defender.payment import (
     successful_payment,
 )
 from group_defender.defend import *
+from group_defender.aio import reply_text, send_message
+from group_defender.core import async_handler, run_blocking
+from group_defender.lazy import prewarm_modules
+from group_defender.members import update_member_status
 from group_defender.store import process_msg, delete_expired_msg
-from group_defender.utils import get_settings
-from group_defender.stats import get_stats
+from group_defender.settings import get_setting, refresh_settings
+from group_defender.stats import get_stats, flush_stats
@@ -0,0 +1,124 @@
+from telegram import Chat
+from telegram.error import (
+    BadRequest,
+    ChatMigrated,
+    Conflict,
+    InvalidToken,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+    TimedOut,
+    Unauthorized,
+)
+from telegram.utils.request import Request
+
+from group_defender.constants import HTTP_BOT_CONNECTIONS, TIMEOUT
+from group_defender.lazy import lazy_import
+
+httpx = lazy_import("httpx")
+
+# The HTTP clients by their names, only used on the loop of the core
+http_clients = {}
+
+
+def get_http_client(name, max_connections):
+    """
+    Get the async HTTP client of the name, created on first use, so that the calls
+    of an update are awaited on the core without holding a thread
+    Args:
+        name: the string of the client name
+        max_connections: the int of the number of connections open at the same time
+
+    Returns:
+        The HTTP client
+    """
+    client = http_clients.get(name)
+    if client is None:
+        client = http_clients[name] = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections)
+        )
+
+    return client
+
+
+async def call_bot(bot, method, **params):
+    """
+    Call a Bot API method on the core, raising the same errors as the bot object
+    Args:
+        bot: the bot object
+        method: the string of the Bot API method name
+        **params: the parameters of the method, None values are left out
+
+    Returns:
+        The result of the method
+    """
+    data = {
+        k: v.to_dict() if hasattr(v, "to_dict") else v
+        for k, v in params.items()
+        if v is not None
+    }
+
+    try:
+        r = await get_http_client("bot", HTTP_BOT_CONNECTIONS).post(
+            f"{bot.base_url}/{method}", json=data, timeout=TIMEOUT
+        )
+    except httpx.TimeoutException as e:
+        raise TimedOut() from e
+    except httpx.HTTPError as e:
+        raise NetworkError(f"{type(e).__name__}: {e}") from e
+
+    # Parsed by the request object of the bot, which raises the flood control and
+    # chat migration errors
+    if 200 <= r.status_code <= 299:
+        return Request._parse(r.content)
+
+    try:
+        message = str(Request._parse(r.content))
+    except (ChatMigrated, RetryAfter):
+        raise
+    except TelegramError:
+        message = "Unknown HTTPError"
+
+    if r.status_code in (401, 403):
+        raise Unauthorized(message)
+    elif r.status_code == 400:
+        raise BadRequest(message)
+    elif r.status_code == 404:
+        raise InvalidToken()
+    elif r.status_code == 409:
+        raise Conflict(message)
+
+    raise NetworkError(f"{message} ({r.status_code})")
+
+
+async def send_message(bot, chat_id, text, **params):
+    return await call_bot(bot, "sendMessage", chat_id=chat_id, text=text, **params)
+
+
+async def reply_text(message, text, quote=None, **params):
+    """
+    Reply to the message, quoting it by default outside of private chats like
+    Message.reply_text
+    Args:
+        message: the message object
+        text: the string of the text
+        quote: the bool indicating if the message is quoted
+        **params: the other parameters of sendMessage
+
+    Returns:
+        The dict of the sent message
+    """
+    if quote is None:
+        quote = message.chat.type != Chat.PRIVATE
+
+    return await send_message(
+        message.bot,
+        message.chat_id,
+        text,
+        reply_to_message_id=message.message_id if quote else None,
+        **params,
+    )
+
+
+async def send_chat_action(bot, chat_id, action):
+    return await call_bot(bot, "sendChatAction", chat_id=chat_id, action=action)
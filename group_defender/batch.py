@@ -0,0 +1,356 @@
+import asyncio
+import threading
+import time
+
+from concurrent.futures import Future
+
+# The single flights by their names
+flights = {}
+
+
+class BatchRequest:
+    def __init__(self, items):
+        self.items = list(items)
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+        return self.results
+
+
+class MicroBatcher:
+    """
+    Collect the items submitted by concurrent callers over a short window and
+    process them together in one call
+    """
+
+    def __init__(self, func, window, max_size):
+        """
+        Args:
+            func: the function that takes a list of items and returns a list of
+                results in the same order
+            window: the number of seconds to wait for more items after the first one
+            max_size: the int of the number of items that flushes the batch early
+        """
+        self.func = func
+        self.window = window
+        self.max_size = max_size
+        self._pending = []
+        self._num_items = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, items):
+        """
+        Submit the items and wait for their results
+        Args:
+            items: the list of items
+
+        Returns:
+            A list of the results of the items
+        """
+        if not items:
+            return []
+
+        request = BatchRequest(items)
+        with self._cond:
+            self._pending.append(request)
+            self._num_items += len(request.items)
+            self._cond.notify()
+
+        return request.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+
+                deadline = time.monotonic() + self.window
+                while self._num_items < self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+
+                    self._cond.wait(remaining)
+
+                requests, self._pending = self._pending, []
+                self._num_items = 0
+
+            # Flush in the background so that a slow call doesn't hold up the next batch
+            threading.Thread(
+                target=flush_requests, args=(self.func, requests), daemon=True
+            ).start()
+
+
+class AsyncMicroBatcher:
+    """
+    Collect the items submitted by concurrent coroutines over a short window and
+    process them together in one call, without holding a thread while waiting. Only
+    used on one event loop.
+    """
+
+    def __init__(self, func, window, max_size):
+        """
+        Args:
+            func: the coroutine function that takes a list of items and returns a
+                list of results in the same order
+            window: the number of seconds to wait for more items after the first one
+            max_size: the int of the number of items that flushes the batch early
+        """
+        self.func = func
+        self.window = window
+        self.max_size = max_size
+        self._pending = []
+        self._num_items = 0
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, items):
+        """
+        Submit the items and wait for their results
+        Args:
+            items: the list of items
+
+        Returns:
+            A list of the results of the items
+        """
+        if not items:
+            return []
+
+        loop = asyncio.get_running_loop()
+        items = list(items)
+        future = loop.create_future()
+        self._pending.append((items, future))
+        self._num_items += len(items)
+
+        if self._num_items >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        requests, self._pending = self._pending, []
+        self._num_items = 0
+
+        # Keep a reference to the task until it is done
+        task = asyncio.ensure_future(self._process(requests))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, requests):
+        try:
+            results = await self.func([x for items, _ in requests for x in items])
+        except Exception as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+
+            return
+
+        start = 0
+        for items, future in requests:
+            end = start + len(items)
+            if not future.done():
+                future.set_result(results[start:end])
+
+            start = end
+
+
+class KeyedBatcher:
+    """
+    Collect the items submitted under the same key over a short window and process
+    them together in one call, e.g. the photos of an album
+    """
+
+    def __init__(self, func, window, max_size):
+        """
+        Args:
+            func: the function that takes a list of items and returns a list of
+                results in the same order
+            window: the number of seconds to wait for more items after the first one
+                of a key
+            max_size: the int of the number of items that flushes a key early
+        """
+        self.func = func
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, items):
+        """
+        Submit the items under the key and wait for their results
+        Args:
+            key: the key to batch the items under
+            items: the list of items
+
+        Returns:
+            A list of the results of the items
+        """
+        request = BatchRequest(items)
+        with self._lock:
+            batch = self._pending.setdefault(key, [])
+            batch.append(request)
+
+            if len(batch) == 1:
+                timer = threading.Timer(self.window, self._flush, args=(key, batch))
+                timer.daemon = True
+                timer.start()
+
+            is_full = sum(len(x.items) for x in batch) >= self.max_size
+
+        if is_full:
+            self._flush(key, batch)
+
+        return request.wait()
+
+    def _flush(self, key, batch):
+        # The batch may have already been flushed early by reaching the maximum size
+        with self._lock:
+            if self._pending.get(key) is not batch:
+                return
+
+            del self._pending[key]
+
+        flush_requests(self.func, batch)
+
+
+class SingleFlight:
+    """
+    Let only the first of the concurrent calls with the same key run, and hand its
+    result to the others instead of repeating the work
+    """
+
+    def __init__(self, name):
+        """
+        Args:
+            name: the string of the name that the collapsed calls are counted under
+        """
+        self.collapsed = 0
+        self._futures = {}
+        self._lock = threading.Lock()
+        flights[name] = self
+
+    async def run(self, key, func, *args, **kwargs):
+        """
+        Await the coroutine function, or the result of the call in flight with the
+        same key, without holding a thread while waiting
+        Args:
+            key: the key of the call
+            func: the coroutine function
+            *args: the positional arguments of the function
+            **kwargs: the keyword arguments of the function
+
+        Returns:
+            The result of the function
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            is_leader = future is None
+
+            if is_leader:
+                future = self._futures[key] = Future()
+            else:
+                self.collapsed += 1
+
+        # Shielded so that a cancelled waiter doesn't cancel the call for the others
+        if not is_leader:
+            return await asyncio.shield(asyncio.wrap_future(future))
+
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            self._forget(key, future)
+            future.set_exception(e)
+            raise
+        except BaseException:
+            self._forget(key, future)
+            future.cancel()
+            raise
+
+        self._forget(key, future)
+        future.set_result(result)
+
+        return result
+
+    def create_task(self, key, func, *args, **kwargs):
+        """
+        Run the coroutine function as a task on the running loop, or share the task
+        in flight with the same key
+        Args:
+            key: the key of the call
+            func: the coroutine function
+            *args: the positional arguments of the function
+            **kwargs: the keyword arguments of the function
+
+        Returns:
+            The task of the result of the function
+        """
+        with self._lock:
+            task = self._futures.get(key)
+            if task is not None:
+                self.collapsed += 1
+
+                return task
+
+            task = self._futures[key] = asyncio.ensure_future(func(*args, **kwargs))
+
+        task.add_done_callback(lambda x: self._forget(key, x))
+
+        return task
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+
+
+def get_collapsed_counts():
+    """
+    Get the number of calls that waited for the result of an identical call in
+    flight since the process started
+    Returns:
+        A dict of the single flight names to their collapsed calls
+    """
+    return {name: x.collapsed for name, x in flights.items()}
+
+
+def flush_requests(func, requests):
+    """
+    Process the items of the requests in one call and hand each request its results
+    Args:
+        func: the function that takes a list of items and returns a list of results
+        requests: the list of batch requests
+
+    Returns:
+        None
+    """
+    items = [x for request in requests for x in request.items]
+    try:
+        results = func(items)
+    except Exception as e:
+        for request in requests:
+            request.error = e
+            request.done.set()
+
+        return
+
+    start = 0
+    for request in requests:
+        end = start + len(request.items)
+        request.results = results[start:end]
+        request.done.set()
+        start = end
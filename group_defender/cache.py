@@ -0,0 +1,76 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    A thread-safe LRU cache where every entry expires after a fixed time to live
+    """
+
+    def __init__(self, maxsize, ttl):
+        """
+        Args:
+            maxsize: the int of the maximum number of entries
+            ttl: the number of seconds an entry stays valid
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get the value of a key and mark it as recently used
+        Args:
+            key: the key to look up
+            default: the value to return if the key is missing or has expired
+
+        Returns:
+            The cached value or the default value
+        """
+        with self._lock:
+            try:
+                expiry, value = self._data[key]
+            except KeyError:
+                return default
+
+            if expiry < time.monotonic():
+                del self._data[key]
+
+                return default
+
+            self._data.move_to_end(key)
+
+            return value
+
+    def set(self, key, value):
+        """
+        Set the value of a key, evicting the least recently used entry if full
+        Args:
+            key: the key to set
+            value: the value to store
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
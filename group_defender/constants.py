@@ -1,5 +1,83 @@
 MSG_LIFETIME = 1  # 1 day
 TIMEOUT = 20
+PREWARM_IMPORTS = True  # Import the lazily loaded modules once the bot has started
+
+# Processing core constants
+INTERACTIVE = "interactive"  # Lane of button callbacks and commands
+MODERATION = "moderation"  # Lane of files and links in groups
+PRIVATE_CHECKS = "private_checks"  # Lane of files and links in private chats
+CORE_LANES = {  # Updates processed at the same time and threads for their calls
+    INTERACTIVE: (16, 8),
+    MODERATION: (48, 24),
+    PRIVATE_CHECKS: (16, 8),
+}
+CORE_CHAT_UPDATES = 4  # Updates of a chat in a lane processed at the same time
+CORE_CHAT_QUEUE = 32  # Waiting updates of a chat before it falls back to cheap checks
+CHEAP_NOTICE_INTERVAL = 10 * 60  # Seconds between the cheap check notices of a chat
+CHEAP_NOTICE_CACHE_SIZE = 1000  # Chats whose last cheap check notice is kept
+
+# Outbound queue constants
+OUTBOX_RATE = 30  # Bot API calls per second across all chats
+OUTBOX_CHAT_RATE = 20 / 60  # Messages per second sent to a chat, 20 a minute in groups
+OUTBOX_CHAT_BURST = 3  # Messages sent to a chat at once before being spaced out
+OUTBOX_NOTICE_WINDOW = 2  # Seconds to gather the notices of a chat into one message
+OUTBOX_NOTICE_MAX = 10  # Notices in one message
+OUTBOX_WORKERS = 8  # Bot API calls in flight at the same time
+OUTBOX_CACHE_SIZE = 10000  # Chats whose send rates are tracked
+
+# Media constants
+MEDIA_SPOOL_SIZE = 5 * 1024 * 1024  # Media larger than 5 MB is spooled to disk
+ANIMATION_FRAMES = 3  # Keyframes scanned per animation, 0 to scan the full gif
+ANIMATION_SCENE_DETECTION = False  # Pick scene changes instead of evenly spaced frames
+SCENE_CANDIDATES = 4  # Candidate frames decoded per keyframe for scene detection
+FRAME_SIZE = 512  # Maximum width and height of the scanned frames
+VIDEO_FRAMES = 4  # Frames scanned per video when the thumbnail is not enough
+VIDEO_MAX_SIZE = 20 * 1024 * 1024  # Larger videos are only checked by thumbnail
+VIDEO_WORKERS = 2  # Videos decoded at the same time
+VIDEO_BORDERLINE_LIKELIHOODS = ["unlikely"]  # Safe thumbnails that need more frames
+MEDIA_GROUP_WINDOW = 1  # Seconds to gather the photos of an album
+MEDIA_GROUP_SIZE = 10  # Maximum number of items in an album
+
+# Stats constants
+STATS_FLUSH_INTERVAL = 30  # Seconds between writing the pending stats
+STATS_FLUSH_SIZE = 500  # Pending chats that trigger an early write
+STATS_BATCH_SIZE = 24  # Chats per transaction, plus a rollup shard makes 25 groups
+STATS_SHARDS = 4  # Shards of the global rollup, to spread out write contention
+STATS_HOUR_RETENTION = 7  # Days of hourly buckets kept, older ones are in the days
+STATS_DAY_RETENTION = 365  # Days of daily buckets kept, older ones are in the months
+
+# Settings constants
+SETTINGS_REFRESH_INTERVAL = 60 * 60  # Seconds between reloading settings, or None
+
+# Expiry sweep constants
+SWEEP_INTERVAL = 10 * 60  # 10 minutes
+SWEEP_DEADLINE = 5 * 60  # Seconds a sweep runs before leaving the rest for the next one
+SWEEP_BATCH_SIZE = 500  # Keys per delete call, the maximum that datastore allows
+SWEEP_WORKERS = 4  # Delete calls in flight at the same time
+
+# Campaign index constants
+CAMPAIGN_TTL = 60 * 60  # Seconds flagged content and senders stay in the index
+CAMPAIGN_INDEX_SIZE = 100000  # Flagged files, links and senders kept
+CAMPAIGN_SENDER_CHATS = 2  # Chats a sender is flagged in before all their content is
+CAMPAIGN_LOOKBACK = 10 * 60  # Seconds of passed messages swept for flagged content
+CAMPAIGN_RECENT_SIZE = 5000  # Passed messages kept for the sweep
+CAMPAIGN_SWEEP_INTERVAL = 30  # Seconds between the sweeps
+# Service accounts shared by the messages of many channels and anonymous admins,
+# which are never flagged as senders
+CAMPAIGN_SERVICE_USERS = (777000, 1087968824, 136817688)
+
+# Chat member cache constants
+MEMBER_CACHE_SIZE = 10000
+MEMBER_CACHE_TTL = 10 * 60  # 10 minutes
+
+# Async HTTP constants
+HTTP_BOT_CONNECTIONS = 100  # Connections to the Bot API open at the same time
+HTTP_SAFE_BROWSING_CONNECTIONS = 10  # Connections to Safe Browsing at the same time
+
+# URL probing constants
+URL_PROBE_TIMEOUT = 5  # Per URL, for each of connecting and reading the headers
+URL_PROBE_DEADLINE = 10  # Per message
+URL_PROBE_CONNECTIONS = 64  # Probes in flight at the same time
 
 # Payment constants
 PAYMENT = "payment"
@@ -42,10 +120,48 @@ GCP_LIKELIHOODS = [
 ]
 GCP_THRESHOLD = 3
 GCP_LIMIT = 950
+GCP_BATCH_SIZE = 16  # Maximum number of images per batch annotate request
 
 # Azure Content Moderator constants
 AZURE_LIMIT = 4950
 AZURE_THRESHOLD = 0.5
+AZURE_WORKERS = 4  # Concurrent requests when scanning several images
+
+# Local classifier constants
+# Lower scores are decided safe without the providers, None to disable. The skin
+# tone score misses drawn content, so only set it with a tuned LOCAL_CLASSIFIER.
+LOCAL_SAFE_THRESHOLD = None
+LOCAL_UNSAFE_THRESHOLD = None  # Higher scores are decided unsafe, None to disable
+
+# Safe Browsing constants
+SAFE_BROWSING_API = "https://safebrowsing.googleapis.com/v4"
+SAFE_BROWSING_THREAT_TYPES = [
+    "MALWARE",
+    "SOCIAL_ENGINEERING",
+    "UNWANTED_SOFTWARE",
+    "POTENTIALLY_HARMFUL_APPLICATION",
+]
+SAFE_BROWSING_UPDATE_INTERVAL = 30 * 60  # 30 minutes
+SAFE_BROWSING_FULL_HASH_TTL = 5 * 60  # 5 minutes
+SAFE_BROWSING_CACHE_SIZE = 10000
+SAFE_BROWSING_BATCH_WINDOW = 0.05  # Seconds to collect lookups across messages
+SAFE_BROWSING_MAX_ENTRIES = 500  # Per lookup request
+
+# API quota constants
+API_LEASE_SIZE = 20  # Calls leased into each instance at a time
+API_RECONCILE_INTERVAL = 10 * 60  # 10 minutes
+
+# Perceptual hash constants
+PHASH_DISTANCE = 6  # Maximum Hamming distance to a known unsafe image
+PHASH_CHUNKS = 4  # Chunks that each hash is split into for multi-index hashing
+PHASH_MERGE_SIZE = 1000  # New hashes kept aside before rebuilding the index
+PHASH_SYNC_INTERVAL = 10 * 60  # 10 minutes
+PHASH_LIKELIHOOD = "likely"  # Likelihood reported for known unsafe images
+
+# Verdict cache constants
+VERDICT_CACHE_SIZE = 10000
+VERDICT_CACHE_TTL = 60 * 60  # 1 hour
+VERDICT_LIFETIME = 7  # 7 days
 
 # Google Datastore constants
 MSG = "Message"
@@ -65,6 +181,20 @@ GCP = "gcp"
 AZURE = "azure"
 FILE = "file"
 CHAT = "Chat"
+GLOBAL_STATS = "Global_Stats"
+NUM_USERS = "num_users"
+NUM_GROUPS = "num_groups"
+VERDICT = "Verdict"
+IS_SAFE = "is_safe"
+LIKELIHOOD = "likelihood"
+PHASH = "PHash"
+CREATED = "created"
+STATS_BUCKET = "Stats_Bucket"
+RESOLUTION = "resolution"
+START = "start"
+HOUR = "hour"
+DAY = "day"
+BLOCKED = "blocked"
 
 # Inline keyboard constants
 UNDO = "undo"
@@ -0,0 +1,338 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from logbook import Logger
+from telegram import Chat
+
+from group_defender.constants import (
+    CORE_CHAT_QUEUE,
+    CORE_CHAT_UPDATES,
+    CORE_LANES,
+    MODERATION,
+    PRIVATE_CHECKS,
+)
+
+# The lane of the update that the running coroutine is processing
+current_lane = contextvars.ContextVar("current_lane", default=None)
+
+# Whether the chat of the update is over its share and only gets cheap checks
+cheap_checks = contextvars.ContextVar("cheap_checks", default=False)
+
+
+class ChatQueue:
+    """
+    The updates of a chat waiting in a lane
+    """
+
+    def __init__(self):
+        self.waiting = deque()
+        self.running = 0
+        self.overloaded = False
+
+
+class Lane:
+    """
+    A priority lane of updates with its own limit and thread pool, so that the
+    updates of a lane never queue behind the updates of another
+
+    The slots of the lane are handed out round-robin across the chats with waiting
+    updates rather than in arrival order, so that a flooding chat gets the same
+    share as any other. A chat with too many waiting updates is over its share and
+    its updates only get cheap checks until its queue has drained.
+    """
+
+    def __init__(self, name, max_updates, io_workers, chat_updates, chat_queue):
+        """
+        Args:
+            name: the string of the lane name
+            max_updates: the int of the number of updates processed at the same time
+            io_workers: the int of the number of threads for blocking calls
+            chat_updates: the int of the number of updates of a chat processed at
+                the same time
+            chat_queue: the int of the number of waiting updates of a chat before
+                it falls back to cheap checks
+        """
+        self.name = name
+        self.free = max_updates
+        self.chat_updates = chat_updates
+        self.chat_queue = chat_queue
+        self.executor = ThreadPoolExecutor(
+            max_workers=io_workers, thread_name_prefix=f"lane-{name}"
+        )
+
+        # Only used on the loop thread, so they don't need a lock
+        self.chats = {}
+        self.rotation = OrderedDict()  # Chats with waiting updates, next one first
+        self.waiting = 0
+        self.running = 0
+        self.processed = 0
+        self.cheap = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    async def acquire(self, chat_id):
+        """
+        Wait for the turn of an update of the chat
+        Args:
+            chat_id: the int of the chat ID
+
+        Returns:
+            A bool indicating if the update only gets cheap checks
+        """
+        chat = self.chats.setdefault(chat_id, ChatQueue())
+        waiter = asyncio.get_running_loop().create_future()
+        chat.waiting.append(waiter)
+        self.rotation.setdefault(chat_id)
+        self.waiting += 1
+
+        if len(chat.waiting) > self.chat_queue and not chat.overloaded:
+            chat.overloaded = True
+            Logger().warn(
+                f"Chat {chat_id} has {len(chat.waiting)} updates waiting in the "
+                f"{self.name} lane, falling back to cheap checks"
+            )
+
+        self.dispatch()
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                chat.waiting.remove(waiter)
+                self.waiting -= 1
+                self.forget(chat_id)
+            else:
+                # Cancelled after being handed a slot, so give it back
+                self.release(chat_id)
+
+            raise
+
+    def release(self, chat_id):
+        """
+        Give back the slot of an update of the chat
+        Args:
+            chat_id: the int of the chat ID
+
+        Returns:
+            None
+        """
+        chat = self.chats[chat_id]
+        chat.running -= 1
+        self.running -= 1
+        self.free += 1
+        self.forget(chat_id)
+        self.dispatch()
+
+    def forget(self, chat_id):
+        chat = self.chats[chat_id]
+        if not chat.waiting:
+            self.rotation.pop(chat_id, None)
+
+            if chat.overloaded:
+                chat.overloaded = False
+                Logger().info(
+                    f"Chat {chat_id} has caught up in the {self.name} lane, "
+                    f"back to full checks"
+                )
+
+            if chat.running == 0:
+                del self.chats[chat_id]
+
+    def dispatch(self):
+        """
+        Hand out the free slots to the next chats in the rotation that are under
+        their own limit
+
+        Returns:
+            None
+        """
+        while self.free > 0:
+            # Chats at their own limit are skipped, there are at most as many of
+            # them as the slots of the lane
+            chat_id = next(
+                (x for x in self.rotation if self.chats[x].running < self.chat_updates),
+                None,
+            )
+            if chat_id is None:
+                return
+
+            chat = self.chats[chat_id]
+            waiter = chat.waiting.popleft()
+            if chat.waiting:
+                self.rotation.move_to_end(chat_id)
+            else:
+                del self.rotation[chat_id]
+
+            chat.running += 1
+            self.running += 1
+            self.waiting -= 1
+            self.free -= 1
+            waiter.set_result(chat.overloaded)
+
+    def get_stats(self):
+        """
+        Returns:
+            A dict of the updates waiting, running, processed and given cheap
+            checks, the chats over their share, and the mean and maximum seconds
+            that the updates waited to start
+        """
+        return {
+            "waiting": self.waiting,
+            "running": self.running,
+            "processed": self.processed,
+            "cheap": self.cheap,
+            "overloaded": sum(x.overloaded for x in self.chats.values()),
+            "mean_wait": self.total_wait / self.processed if self.processed else 0,
+            "max_wait": self.max_wait,
+        }
+
+
+class AsyncCore:
+    """
+    An event loop on its own thread that processes updates as coroutines
+
+    Updates are processed in priority lanes. Each lane limits the number of updates
+    processed at the same time overall and in each chat, and shares its capacity
+    fairly across chats, so that a flooding chat can't starve the others and a
+    flood in one lane can't delay the others. The Bot API, datastore and vision
+    clients are synchronous, so their calls are awaited on the thread pool of the
+    lane, which lets the independent calls of an update overlap without tying up a
+    dispatcher worker for the whole update.
+    """
+
+    def __init__(self, lanes, chat_updates, chat_queue):
+        """
+        Args:
+            lanes: the dict of lane names to tuples of the number of updates
+                processed at the same time and the number of threads
+            chat_updates: the int of the number of updates of a chat in a lane
+                processed at the same time
+            chat_queue: the int of the number of waiting updates of a chat in a
+                lane before it falls back to cheap checks
+        """
+        self.lanes = {
+            name: Lane(name, *limits, chat_updates, chat_queue)
+            for name, limits in lanes.items()
+        }
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def submit(self, lane_name, chat_id, coro):
+        """
+        Schedule the coroutine of an update from any thread
+        Args:
+            lane_name: the string of the lane name
+            chat_id: the int of the chat ID of the update
+            coro: the coroutine
+
+        Returns:
+            The concurrent future of the result of the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.process(self.lanes[lane_name], chat_id, coro), self.loop
+        )
+
+    async def process(self, lane, chat_id, coro):
+        arrival = time.monotonic()
+        try:
+            cheap = await lane.acquire(chat_id)
+        except asyncio.CancelledError:
+            coro.close()
+            raise
+
+        wait = time.monotonic() - arrival
+        lane.total_wait += wait
+        lane.max_wait = max(lane.max_wait, wait)
+        lane.cheap += cheap
+        current_lane.set(lane)
+        cheap_checks.set(cheap)
+
+        try:
+            return await coro
+        finally:
+            lane.processed += 1
+            lane.release(chat_id)
+
+    def get_lane_stats(self):
+        """
+        Returns:
+            A dict of the lane names to the dicts of their stats
+        """
+        return {name: lane.get_stats() for name, lane in self.lanes.items()}
+
+
+core = AsyncCore(CORE_LANES, CORE_CHAT_UPDATES, CORE_CHAT_QUEUE)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking call on the thread pool of the current lane and wait for it
+    Args:
+        func: the function
+        *args: the positional arguments of the function
+        **kwargs: the keyword arguments of the function
+
+    Returns:
+        The result of the function
+    """
+    lane = current_lane.get()
+    loop = asyncio.get_running_loop()
+
+    return await loop.run_in_executor(
+        lane.executor if lane is not None else None,
+        functools.partial(func, *args, **kwargs),
+    )
+
+
+def get_lane(update):
+    """
+    Get the lane of a file or link check from the type of its chat
+    Args:
+        update: the update object
+
+    Returns:
+        The string of the lane name
+    """
+    chat = update.effective_chat
+    if chat is not None and chat.type in (Chat.GROUP, Chat.SUPERGROUP):
+        return MODERATION
+
+    return PRIVATE_CHECKS
+
+
+def async_handler(lane=None):
+    """
+    Turn a coroutine function into a handler callback that processes the update on
+    the core and returns straight away, in place of run_async. Errors are passed to
+    the dispatcher's error handlers.
+    Args:
+        lane: the string of the lane name, or None to pick the lane of file and link
+            checks from the type of the chat
+
+    Returns:
+        The decorator of the coroutine function taking the update and the context
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def callback(update, context):
+            chat_id = update.effective_chat.id if update.effective_chat else None
+            lane_name = lane if lane is not None else get_lane(update)
+            future = core.submit(lane_name, chat_id, func(update, context))
+
+            def report_error(done):
+                if not done.cancelled() and done.exception() is not None:
+                    core.lanes[lane_name].executor.submit(
+                        context.dispatcher.dispatch_error, update, done.exception()
+                    )
+
+            future.add_done_callback(report_error)
+
+        return callback
+
+    return decorator
@@ -1,2 +1,10 @@
 from group_defender.defend.file import process_file
 from group_defender.defend.url import check_url
+from group_defender.defend.safe_browsing import (
+    SAFE_BROWSING_DB,
+    load_hash_prefixes,
+    update_hash_prefixes,
+)
+from group_defender.defend.quota import reconcile_api_counts
+from group_defender.defend.phash import load_phash_index, sync_phash_index
+from group_defender.defend.campaign import sweep_campaigns
@@ -0,0 +1,189 @@
+import hashlib
+import threading
+import time
+
+from collections import deque
+from logbook import Logger
+
+from group_defender.cache import TTLCache
+from group_defender.constants import (
+    CAMPAIGN_INDEX_SIZE,
+    CAMPAIGN_LOOKBACK,
+    CAMPAIGN_RECENT_SIZE,
+    CAMPAIGN_SENDER_CHATS,
+    CAMPAIGN_SERVICE_USERS,
+    CAMPAIGN_TTL,
+)
+from group_defender.stats import update_stats
+from group_defender.utils import describe_file, filter_msg
+
+# Flagged files and links to True, and flagged senders to the chats they were
+# flagged in
+campaign_index = TTLCache(CAMPAIGN_INDEX_SIZE, CAMPAIGN_TTL)
+
+# Messages in groups that passed their checks, to be swept once their content is
+# flagged elsewhere
+recent_msgs = deque(maxlen=CAMPAIGN_RECENT_SIZE)
+campaign_lock = threading.Lock()
+
+
+class RecentMsg:
+    def __init__(self, update, context, file_id, file_type, keys):
+        self.update = update
+        self.context = context
+        self.file_id = file_id
+        self.file_type = file_type
+        self.keys = keys
+        self.time = time.monotonic()
+
+
+def file_key(file_unique_id):
+    return f"file:{file_unique_id}"
+
+
+def url_key(url):
+    """
+    Get the campaign key of a link from the SHA-256 digest of its normalized url
+    Args:
+        url: the string of the normalized url
+
+    Returns:
+        The string of the campaign key
+    """
+    return f"url:{hashlib.sha256(url.encode()).hexdigest()}"
+
+
+def sender_key(sender_id):
+    return f"sender:{sender_id}"
+
+
+def campaign_sender(message):
+    """
+    Get the ID that the sender of a message is flagged by, which is the chat that
+    the message was sent on behalf of if there is one
+    Args:
+        message: the message object
+
+    Returns:
+        The int of the sender ID, or None if the message was sent by a service
+        account shared by many senders
+    """
+    if message.sender_chat is not None:
+        return message.sender_chat.id
+    elif message.from_user is None or message.from_user.id in CAMPAIGN_SERVICE_USERS:
+        return None
+
+    return message.from_user.id
+
+
+def flag_campaign(chat_id, sender_id, keys):
+    """
+    Add the content of a message found unsafe in a group, and its sender, to the
+    campaign index
+    Args:
+        chat_id: the int of the chat ID
+        sender_id: the int of the sender ID, or None to only flag the content
+        keys: the list of the campaign keys of the unsafe files or links
+
+    Returns:
+        None
+    """
+    with campaign_lock:
+        for key in keys:
+            campaign_index.set(key, True)
+
+        if sender_id is not None:
+            chats = campaign_index.get(sender_key(sender_id), frozenset())
+            campaign_index.set(sender_key(sender_id), chats | {chat_id})
+
+
+def is_flagged(sender_id, keys):
+    """
+    Check if the content of a message or its sender has been flagged recently
+    Args:
+        sender_id: the int of the sender ID, or None to only check the content
+        keys: the list of the campaign keys of the files or links
+
+    Returns:
+        A bool indicating if the message is part of a campaign
+    """
+    if any(campaign_index.get(x) is not None for x in keys):
+        return True
+    elif sender_id is None:
+        return False
+
+    chats = campaign_index.get(sender_key(sender_id), frozenset())
+
+    return len(chats) >= CAMPAIGN_SENDER_CHATS
+
+
+def remove_campaign_msg(update, context, file_id, file_type):
+    """
+    Remove a message in a group that is part of a campaign without checking it again
+    Args:
+        update: the update object
+        context: the context object
+        file_id: the int of the file ID
+        file_type: the string of the file type
+
+    Returns:
+        None
+    """
+    message = update.effective_message
+    text = (
+        f"I've deleted {describe_file(file_type)} that matches what I've recently "
+        f"removed elsewhere (sent by @{message.from_user.username})."
+    )
+    filter_msg(update, context, file_id, file_type, text)
+    update_stats(message.chat_id, {file_type: 1}, {file_type: 1})
+
+
+def add_recent_msg(update, context, file_id, file_type, keys):
+    """
+    Keep a message in a group that passed its checks, so that it can be removed if
+    its content is flagged in another chat shortly after
+    Args:
+        update: the update object
+        context: the context object
+        file_id: the int of the file ID
+        file_type: the string of the file type
+        keys: the list of the campaign keys of the files or links
+
+    Returns:
+        None
+    """
+    with campaign_lock:
+        recent_msgs.append(RecentMsg(update, context, file_id, file_type, keys))
+
+
+def sweep_campaigns(_):
+    """
+    Remove the recent messages that passed their checks before their content or
+    sender was flagged
+    Args:
+        _: unused variable
+
+    Returns:
+        None
+    """
+    start = time.monotonic()
+    flagged = []
+
+    with campaign_lock:
+        msgs = [x for x in recent_msgs if start - x.time <= CAMPAIGN_LOOKBACK]
+        recent_msgs.clear()
+
+        for msg in msgs:
+            if is_flagged(campaign_sender(msg.update.effective_message), msg.keys):
+                flagged.append(msg)
+            else:
+                recent_msgs.append(msg)
+
+    for msg in flagged:
+        remove_campaign_msg(msg.update, msg.context, msg.file_id, msg.file_type)
+
+    if flagged:
+        Logger().info(
+            f"Swept {len(flagged)} campaign messages in "
+            f"{time.monotonic() - start:.1f}s"
+        )
@@ -0,0 +1,122 @@
+import importlib
+import os
+import threading
+
+from collections import Counter
+from dotenv import load_dotenv
+
+from group_defender.constants import (
+    GCP_LIKELIHOODS,
+    LOCAL_SAFE_THRESHOLD,
+    LOCAL_UNSAFE_THRESHOLD,
+)
+from group_defender.lazy import lazy_import
+
+Image = lazy_import("PIL.Image")
+np = lazy_import("numpy")
+
+LOCAL_SAFE = "local_safe"
+LOCAL_UNSAFE = "local_unsafe"
+ESCALATED = "escalated"
+
+tier_counts = Counter()
+counts_lock = threading.Lock()
+
+
+def skin_score(image):
+    """
+    Score an image by the fraction of its pixels that have a skin tone, a cheap
+    signal that images without any skin are unlikely to be NSFW
+    Args:
+        image: the image object
+
+    Returns:
+        The float score between 0 and 1
+    """
+    pixels = np.asarray(image.convert("YCbCr").resize((64, 64)))
+    cb, cr = pixels[..., 1], pixels[..., 2]
+    skin = (cb >= 77) & (cb <= 127) & (cr >= 133) & (cr <= 173)
+
+    return float(skin.mean())
+
+
+def load_classifier():
+    """
+    Load the local classifier set by LOCAL_CLASSIFIER in the form of
+    "module:function", where the function takes an image object and returns the
+    probability of it being NSFW. The skin tone score is used if it is not set.
+
+    Returns:
+        The classifier function
+    """
+    load_dotenv()
+    name = os.environ.get("LOCAL_CLASSIFIER")
+
+    if name is None:
+        return skin_score
+
+    module_name, func_name = name.split(":")
+
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+classifier = load_classifier()
+
+
+def classify_locally(media):
+    """
+    Decide clearly safe or unsafe images with the local classifier
+    Args:
+        media: the file object of the image
+
+    Returns:
+        A tuple of a bool indicating if the image is safe or not and the likelihood,
+        or None if the image has to be escalated to the cloud providers
+    """
+    if LOCAL_SAFE_THRESHOLD is None and LOCAL_UNSAFE_THRESHOLD is None:
+        count_tier(ESCALATED)
+
+        return None
+
+    try:
+        media.seek(0)
+        with Image.open(media) as image:
+            score = classifier(image)
+    except (OSError, ValueError):
+        score = None
+
+    if (
+        score is not None
+        and LOCAL_SAFE_THRESHOLD is not None
+        and score < LOCAL_SAFE_THRESHOLD
+    ):
+        count_tier(LOCAL_SAFE)
+
+        return True, GCP_LIKELIHOODS[1]
+    elif (
+        score is not None
+        and LOCAL_UNSAFE_THRESHOLD is not None
+        and score >= LOCAL_UNSAFE_THRESHOLD
+    ):
+        count_tier(LOCAL_UNSAFE)
+
+        return False, GCP_LIKELIHOODS[4]
+
+    count_tier(ESCALATED)
+
+    return None
+
+
+def count_tier(name):
+    with counts_lock:
+        tier_counts[name] += 1
+
+
+def get_tier_counts():
+    """
+    Get the number of images decided by each tier since the process started
+    Returns:
+        A dict of the images decided safe and unsafe locally, and escalated
+    """
+    with counts_lock:
+        return {x: tier_counts[x] for x in (LOCAL_SAFE, LOCAL_UNSAFE, ESCALATED)}
@@ -1,14 +1,17 @@
+import io
 import os
 import requests
+import shutil
 import tempfile
+import threading
+import time
 
-from dotenv import load_dotenv
 from logbook import Logger
-from moviepy.editor import VideoFileClip
 from telegram import Chat, ChatMember, ChatAction
 from telegram.constants import MAX_FILESIZE_DOWNLOAD
-from telegram.ext.dispatcher import run_async
 
+from group_defender.aio import reply_text
+from group_defender.batch import KeyedBatcher, SingleFlight
 from group_defender.constants import (
     AUDIO,
     DOCUMENT,
@@ -19,29 +22,69 @@ from group_defender.constants import (
     WARNING,
     FAILED,
     ANIMATION,
+    ANIMATION_FRAMES,
+    ANIMATION_SCENE_DETECTION,
+    FRAME_SIZE,
+    MEDIA_GROUP_SIZE,
+    MEDIA_GROUP_WINDOW,
+    PHASH_LIKELIHOOD,
     STICKER,
+    VIDEO_BORDERLINE_LIKELIHOODS,
+    VIDEO_FRAMES,
+    VIDEO_MAX_SIZE,
+    VIDEO_WORKERS,
 )
-from group_defender.defend.photo import check_photo
-from group_defender.utils import filter_msg, get_setting
+from group_defender.defend.campaign import (
+    add_recent_msg,
+    campaign_sender,
+    file_key,
+    flag_campaign,
+    is_flagged,
+    remove_campaign_msg,
+)
+from group_defender.defend.classifier import classify_locally
+from group_defender.defend.media import download_media, sample_frames
+from group_defender.defend.phash import dhash, find_unsafe_hash, add_unsafe_hash
+from group_defender.defend.photo import (
+    combine_verdicts,
+    scan_photo,
+    scan_photos,
+    send_photo_verdict,
+)
+from group_defender.defend.verdict import (
+    uid_key,
+    digest_key,
+    get_verdict,
+    store_verdict,
+)
+from group_defender.core import async_handler, cheap_checks, run_blocking
+from group_defender.lazy import lazy_import
+from group_defender.members import fetch_member_status
+from group_defender.settings import get_setting
+from group_defender.utils import filter_msg, send_cheap_notice
 from group_defender.stats import update_stats
 
-load_dotenv()
-SCANNER_TOKEN = os.environ.get("SCANNER_TOKEN")
+mpy = lazy_import("moviepy.editor")
 
-if SCANNER_TOKEN is None:
-    SCANNER_TOKEN = get_setting("SCANNER_TOKEN")
+media_group_batcher = KeyedBatcher(scan_photos, MEDIA_GROUP_WINDOW, MEDIA_GROUP_SIZE)
+video_semaphore = threading.BoundedSemaphore(VIDEO_WORKERS)
 
+# The same file forwarded to many chats at once is only downloaded and scanned once
+media_flights = SingleFlight("media")
 
-@run_async
-def process_file(update, context):
+
+@async_handler()
+async def process_file(update, context):
     # Check if bot in group and if bot is a group admin, if not, files will not be checked
     message = update.effective_message
     if (
         message.chat.type in (Chat.GROUP, Chat.SUPERGROUP)
-        and message.chat.get_member(context.bot.id).status != ChatMember.ADMINISTRATOR
+        and await fetch_member_status(context.bot, message.chat_id, context.bot.id)
+        != ChatMember.ADMINISTRATOR
     ):
-        message.reply_text(
-            "Set me as a group admin so that I can start checking files like this."
+        await reply_text(
+            message,
+            "Set me as a group admin so that I can start checking files like this.",
         )
 
         return
@@ -62,50 +105,288 @@ def process_file(update, context):
     file = file[-1] if file_type == PHOTO else file
     file_size = file.file_size
 
-    # Check if file is too large for bot to download
-    if file_size > MAX_FILESIZE_DOWNLOAD:
+    # Remove the content that has already been flagged in a group without checking
+    # it again
+    is_group = message.chat.type in (Chat.GROUP, Chat.SUPERGROUP)
+    campaign_keys = [file_key(file.file_unique_id)]
+
+    if is_group and is_flagged(campaign_sender(message), campaign_keys):
+        await run_blocking(
+            remove_campaign_msg, update, context, file.file_id, file_type
+        )
+
+        return
+
+    # Check if file is too large for bot to download, videos can still be checked by
+    # their thumbnails
+    if file_size > MAX_FILESIZE_DOWNLOAD and not (
+        file_type == VIDEO and file.thumb is not None
+    ):
         if message.chat.type == Chat.PRIVATE:
-            message.reply_text(
-                f"Your {file_type} is too large for me to download and check."
+            await reply_text(
+                message, f"Your {file_type} is too large for me to download and check."
             )
 
         return
     elif file_type == STICKER and file.is_animated:
         if message.chat.type == Chat.PRIVATE:
-            message.reply_text(f"Animated stickers are not supported yet")
+            await reply_text(message, f"Animated stickers are not supported yet")
 
         return
 
-    with tempfile.NamedTemporaryFile() as tf1, tempfile.NamedTemporaryFile(
-        suffix=".gif"
-    ) as tf2:
-        file_id = file.file_id
-        file_size = file.file_size
-        file_name = tf1.name
+    # The chat is sending more than its share, so only check what can be checked
+    # without the cloud providers
+    cheap = cheap_checks.get()
+    if cheap:
+        send_cheap_notice(update)
 
-        tele_file = context.bot.get_file(file_id)
-        tele_file.download(file_name)
+    file_id = file.file_id
+    flight_key = (uid_key(file.file_unique_id), cheap)
+
+    if file_type in (ANIMATION, PHOTO, STICKER) or (file.mime_type or "").startswith(
+        "image"
+    ):
+        verdict = await media_flights.run(
+            flight_key,
+            run_blocking,
+            get_media_verdict,
+            update,
+            context,
+            file,
+            file_type,
+            cheap,
+        )
+    elif file_type == VIDEO:
+        verdict = await media_flights.run(
+            flight_key, run_blocking, get_video_verdict, update, context, file, cheap
+        )
+    else:
+        verdict = None
+
+    blocked = None
+    if verdict is not None:
+        await run_blocking(
+            send_photo_verdict, update, context, file_id, file_type, *verdict
+        )
+        if verdict[0] is False:
+            blocked = {file_type: 1}
+
+    if is_group and blocked:
+        flag_campaign(message.chat_id, campaign_sender(message), campaign_keys)
+    elif is_group:
+        add_recent_msg(update, context, file_id, file_type, campaign_keys)
+
+    update_stats(message.chat_id, {file_type: 1}, blocked)
+
+
+def get_media_verdict(update, context, file, file_type, cheap=False):
+    """
+    Get the verdict of a photo, sticker or animation, only downloading and scanning
+    it if there is no cached verdict for the same content
+    Args:
+        update: the update object
+        context: the context object
+        file: the file object
+        file_type: the string of the file type
+        cheap: the bool indicating if only the local checks are used
+
+    Returns:
+        A tuple of a bool indicating if the file is safe or not and the likelihood,
+        or None if the file could not be scanned
+    """
+    cache_keys = [uid_key(file.file_unique_id)]
+    verdict = get_verdict(cache_keys[0])
+
+    if verdict is not None:
+        return verdict
+
+    with download_media(context.bot, file.file_id) as media:
+        # Same content may have been sent under a different file
+        cache_keys.append(digest_key(media))
+        verdict = get_verdict(cache_keys[1])
+
+        if verdict is not None:
+            store_verdict(cache_keys[:1], *verdict)
+
+            return verdict
+
+        # Catch re-encoded variants of known unsafe images without an API call
+        image_hash = None if file_type == ANIMATION else dhash(media)
+        if image_hash is not None and find_unsafe_hash(image_hash):
+            verdict = (False, PHASH_LIKELIHOOD)
+            store_verdict(cache_keys, *verdict)
+
+            return verdict
+
+        # A local verdict is only good for this update, so that the file gets its
+        # full scan once the chat is back to full checks
+        if cheap:
+            return None if file_type == ANIMATION else classify_locally(media)
+
+        message = update.effective_message
+        message.chat.send_action(ChatAction.TYPING)
 
-        # Convert animation to gif
         if file_type == ANIMATION:
-            clip = VideoFileClip(tf1.name)
-            clip.write_gif(tf2.name, program="ffmpeg", logger=None)
-            file_size = os.path.getsize(tf2.name)
+            verdict = scan_animation(media)
+        elif message.media_group_id is not None:
+            # Scan the photos of an album together
+            verdict = media_group_batcher.submit(message.media_group_id, [media])[0]
+        else:
+            verdict = scan_photo(media)
+
+    if verdict is not None:
+        store_verdict(cache_keys, *verdict, scanned=True)
 
-            if file_size <= MAX_FILESIZE_DOWNLOAD:
-                file_name = tf2.name
+        if verdict[0] is False and image_hash is not None:
+            add_unsafe_hash(image_hash)
 
-        if file_size <= MAX_FILESIZE_DOWNLOAD:
-            is_safe = True
-            if file_type in [ANIMATION, PHOTO, STICKER] or file.mime_type.startswith(
-                "image"
-            ):
-                is_safe = check_photo(update, context, file_id, file_name, file_type)
+    return verdict
+
+
+def get_video_verdict(update, context, file, cheap=False):
+    """
+    Get the verdict of a video, scanning its thumbnail first and only sampling a
+    bounded number of frames if there is no thumbnail or it is borderline
+    Args:
+        update: the update object
+        context: the context object
+        file: the video object
+        cheap: the bool indicating if only the local checks are used
+
+    Returns:
+        A tuple of a bool indicating if the video is safe or not and the likelihood,
+        or None if the video could not be scanned
+    """
+    cache_keys = [uid_key(file.file_unique_id)]
+    verdict = get_verdict(cache_keys[0])
+
+    if verdict is not None:
+        return verdict
+
+    # The local verdict of a thumbnail isn't enough to be cached for the video
+    if cheap:
+        if file.thumb is None:
+            return None
+
+        with download_media(context.bot, file.thumb.file_id) as media:
+            return classify_locally(media)
+
+    update.effective_message.chat.send_action(ChatAction.TYPING)
+    if file.thumb is not None:
+        with download_media(context.bot, file.thumb.file_id) as media:
+            verdict = scan_photo(media)
+
+        is_safe, likelihood = verdict
+        if is_safe is None:
+            return verdict
+
+        if not is_safe or likelihood not in VIDEO_BORDERLINE_LIKELIHOODS:
+            store_verdict(cache_keys, *verdict, scanned=True)
+
+            return verdict
+
+    # Bots can't download files over MAX_FILESIZE_DOWNLOAD
+    if file.file_size <= min(VIDEO_MAX_SIZE, MAX_FILESIZE_DOWNLOAD):
+        with tempfile.NamedTemporaryFile() as tf:
+            context.bot.get_file(file.file_id).download(out=tf)
+            tf.flush()
+
+            # Limit the number of videos being decoded at the same time
+            with video_semaphore:
+                frames = sample_frames(tf.name, VIDEO_FRAMES, max_height=FRAME_SIZE)
+
+        verdicts = scan_photos([io.BytesIO(x) for x in frames])
+        if verdict is not None:
+            verdicts.append(verdict)
+
+        verdict = combine_verdicts(verdicts)
+
+    if verdict is not None:
+        store_verdict(cache_keys, *verdict, scanned=True)
+
+    return verdict
+
+
+def scan_animation(media):
+    """
+    Scan the animation, either by its keyframes or by converting it to a gif
+    Args:
+        media: the file object of the animation
+
+    Returns:
+        A tuple of a bool indicating if the animation is safe or not and the
+        likelihood, or None if the animation could not be scanned
+    """
+    with tempfile.NamedTemporaryFile() as tf:
+        media.seek(0)
+        shutil.copyfileobj(media, tf)
+        tf.flush()
+
+        if ANIMATION_FRAMES == 0:
+            return scan_gif(tf.name)
+
+        start_time = time.perf_counter()
+        start_cpu = time.thread_time()
+        start_child_cpu = get_child_cpu_time()
+        frames = sample_frames(tf.name, ANIMATION_FRAMES, ANIMATION_SCENE_DETECTION)
+
+        # The frames are decoded by ffmpeg processes, whose CPU time is counted once
+        # they have exited. Those of the animations sampled at the same time on other
+        # threads are counted too.
+        child_cpu = get_child_cpu_time() - start_child_cpu
+
+    # Stop at the first frame if it is already unsafe, otherwise scan the rest of the
+    # frames in one batch
+    verdicts = [scan_photo(io.BytesIO(frames[0]))] if frames else []
+    if verdicts and verdicts[0][0] is True and len(frames) > 1:
+        verdicts.extend(scan_photos([io.BytesIO(x) for x in frames[1:]]))
+
+    is_safe, likelihood = combine_verdicts(verdicts)
+    num_bytes = sum(len(x) for x in frames[: len(verdicts)])
+
+    log = Logger()
+    log.info(
+        f"Scanned animation with {len(verdicts)} of {len(frames)} frames: "
+        f"{time.thread_time() - start_cpu:.3f}s CPU, "
+        f"{child_cpu:.3f}s ffmpeg CPU, "
+        f"{time.perf_counter() - start_time:.3f}s elapsed, {num_bytes} bytes uploaded"
+    )
+
+    return is_safe, likelihood
+
+
+def get_child_cpu_time():
+    """
+    Returns:
+        The float of the user and system CPU seconds of the child processes that
+        have exited
+    """
+    times = os.times()
+
+    return times.children_user + times.children_system
+
+
+def scan_gif(file_name):
+    """
+    Convert the animation to a gif and scan it
+    Args:
+        file_name: the string of the animation file name
+
+    Returns:
+        A tuple of a bool indicating if the animation is safe or not and the
+        likelihood, or None if the gif is too large to be scanned
+    """
+    with tempfile.NamedTemporaryFile(suffix=".gif") as tf:
+        clip = mpy.VideoFileClip(file_name)
+        try:
+            clip.write_gif(tf.name, program="ffmpeg", logger=None)
+        finally:
+            clip.close()
 
-            # if is_safe is None or is_safe:
-            #     check_file(update, context, file_id, file_name, file_type)
+        if os.path.getsize(tf.name) > MAX_FILESIZE_DOWNLOAD:
+            return None
 
-    update_stats(message.chat_id, {file_type: 1})
+        return scan_photo(tf)
 
 
 def check_file(update, context, file_id, file_name, file_type):
@@ -165,11 +446,11 @@ def scan_file(file_name=None, file_url=None):
     is_safe = True
     status = matches = None
     url = "https://beta.attachmentscanner.com/v0.1/scans"
-    headers = {"authorization": f"bearer {SCANNER_TOKEN}"}
+    headers = {"authorization": f'bearer {get_setting("SCANNER_TOKEN")}'}
 
     if file_name is not None:
-        files = {"file": open(file_name, "rb")}
-        r = requests.post(url, headers=headers, files=files)
+        with open(file_name, "rb") as f:
+            r = requests.post(url, headers=headers, files={"file": f})
     else:
         json = {"url": file_url}
         r = requests.post(url, headers=headers, json=json)
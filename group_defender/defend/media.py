@@ -0,0 +1,110 @@
+import io
+import tempfile
+
+from group_defender.constants import FRAME_SIZE, MEDIA_SPOOL_SIZE, SCENE_CANDIDATES
+from group_defender.lazy import lazy_import
+
+Image = lazy_import("PIL.Image")
+mpy = lazy_import("moviepy.editor")
+np = lazy_import("numpy")
+
+
+def download_media(bot, file_id):
+    """
+    Download a file into memory, spooling it to disk if it is larger than
+    MEDIA_SPOOL_SIZE
+    Args:
+        bot: the bot object
+        file_id: the int of the file ID
+
+    Returns:
+        The spooled temporary file object, which should be closed by the caller
+    """
+    media = tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_SIZE)
+    try:
+        bot.get_file(file_id).download(out=media)
+    except Exception:
+        media.close()
+        raise
+
+    media.seek(0)
+
+    return media
+
+
+def read_media(media):
+    """
+    Get the full content of a media file object
+    Args:
+        media: the file object
+
+    Returns:
+        The bytes of the content
+    """
+    media.seek(0)
+
+    return media.read()
+
+
+def sample_frames(file_name, num_frames, scene_detection=False, max_height=None):
+    """
+    Decode a small number of downsized keyframes of a video without decoding the
+    rest of it
+    Args:
+        file_name: the string of the video file name
+        num_frames: the int of the number of keyframes
+        scene_detection: the bool indicating if keyframes should be picked at scene
+            changes instead of being evenly spaced
+        max_height: the int of the height to have the frames decoded at, which
+            bounds the memory used by large videos
+
+    Returns:
+        A list of the bytes of the JPEG encoded keyframes
+    """
+    num_candidates = num_frames * SCENE_CANDIDATES if scene_detection else num_frames
+    images = []
+
+    target_resolution = None if max_height is None else (max_height, None)
+    clip = mpy.VideoFileClip(
+        file_name, audio=False, target_resolution=target_resolution
+    )
+    try:
+        for i in range(num_candidates):
+            image = Image.fromarray(
+                clip.get_frame(clip.duration * (i + 0.5) / num_candidates)
+            )
+            image.thumbnail((FRAME_SIZE, FRAME_SIZE))
+            images.append(image.convert("RGB"))
+    finally:
+        clip.close()
+
+    if scene_detection:
+        images = pick_scene_changes(images, num_frames)
+
+    frames = []
+    for image in images:
+        buf = io.BytesIO()
+        image.save(buf, "JPEG", quality=85)
+        frames.append(buf.getvalue())
+
+    return frames
+
+
+def pick_scene_changes(images, num_frames):
+    """
+    Pick the first image and the images that differ the most from the ones before
+    Args:
+        images: the list of the image objects in order
+        num_frames: the int of the number of images to pick
+
+    Returns:
+        A list of the picked image objects in order
+    """
+    pixels = [
+        np.asarray(x.convert("L").resize((32, 32)), dtype=np.int16) for x in images
+    ]
+    diffs = [np.abs(a - b).mean() for a, b in zip(pixels, pixels[1:])]
+    changes = sorted(range(len(diffs)), key=lambda i: diffs[i], reverse=True)
+    indices = sorted([0] + [i + 1 for i in changes[: num_frames - 1]])
+
+    return [images[i] for i in indices]
@@ -0,0 +1,221 @@
+import os
+import tempfile
+import threading
+
+from datetime import datetime
+from dotenv import load_dotenv
+from itertools import combinations
+
+from group_defender.constants import PHASH_CHUNKS, PHASH_DISTANCE, PHASH_MERGE_SIZE
+from group_defender.lazy import lazy_import
+from group_defender.storage import storage
+
+Image = lazy_import("PIL.Image")
+np = lazy_import("numpy")
+
+load_dotenv()
+PHASH_INDEX_FILE = os.environ.get(
+    "PHASH_INDEX_FILE", os.path.join(tempfile.gettempdir(), "phash_index.bin")
+)
+
+# The time of the last sync with the storage, kept apart from the index file
+# whose modified time also changes with the hashes added locally
+PHASH_SYNC_FILE = f"{PHASH_INDEX_FILE}.sync"
+
+CHUNK_BITS = 64 // PHASH_CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+class PHashIndex:
+    """
+    A multi-index hashing index of 64-bit perceptual hashes
+
+    Each hash is split into PHASH_CHUNKS chunks. If two hashes are within a Hamming
+    distance of r, at least one of their chunks is within r // PHASH_CHUNKS, so a
+    lookup only has to check the hashes that share a chunk with one of the few
+    variants of the query chunks. The chunks are kept as sorted numpy arrays, which
+    are quick to build at startup and compact with millions of hashes.
+    """
+
+    def __init__(self, hashes=()):
+        """
+        Args:
+            hashes: the iterable of int hashes
+        """
+        self._lock = threading.Lock()
+        self._state = build_state(np.array(hashes, dtype=np.uint64), ())
+
+    def __len__(self):
+        hashes, _, pending = self._state
+
+        return len(hashes) + len(pending)
+
+    def add(self, image_hash):
+        """
+        Add a hash, merging the recently added hashes into the sorted chunks once
+        there are PHASH_MERGE_SIZE of them
+        Args:
+            image_hash: the int hash
+
+        Returns:
+            None
+        """
+        with self._lock:
+            hashes, chunks, pending = self._state
+            pending += (image_hash,)
+
+            if len(pending) >= PHASH_MERGE_SIZE:
+                hashes = np.concatenate([hashes, np.array(pending, dtype=np.uint64)])
+                self._state = build_state(hashes, ())
+            else:
+                self._state = (hashes, chunks, pending)
+
+    def find(self, image_hash, max_distance=PHASH_DISTANCE):
+        """
+        Check if there is a hash within the Hamming distance of the hash
+        Args:
+            image_hash: the int hash
+            max_distance: the int of the maximum Hamming distance
+
+        Returns:
+            A bool indicating if there is a matching hash
+        """
+        hashes, chunks, pending = self._state
+        radius = max_distance // PHASH_CHUNKS
+        candidates = set()
+
+        for i, (values, order) in enumerate(chunks):
+            chunk = (image_hash >> (i * CHUNK_BITS)) & CHUNK_MASK
+            for variant in chunk_variants(chunk, radius):
+                variant = np.uint32(variant)
+                lo = np.searchsorted(values, variant, "left")
+                hi = np.searchsorted(values, variant, "right")
+                candidates.update(int(x) for x in hashes[order[lo:hi]])
+
+        return any(
+            bin(x ^ image_hash).count("1") <= max_distance
+            for x in candidates.union(pending)
+        )
+
+
+def build_state(hashes, pending):
+    chunks = []
+    for i in range(PHASH_CHUNKS):
+        values = (hashes >> np.uint64(i * CHUNK_BITS)) & np.uint64(CHUNK_MASK)
+        values = values.astype(np.uint32)
+        order = np.argsort(values).astype(np.uint32)
+        chunks.append((values[order], order))
+
+    return hashes, chunks, pending
+
+
+def chunk_variants(chunk, radius):
+    for distance in range(radius + 1):
+        for bits in combinations(range(CHUNK_BITS), distance):
+            variant = chunk
+            for bit in bits:
+                variant ^= 1 << bit
+
+            yield variant
+
+
+def dhash(media):
+    """
+    Get the 64-bit difference hash of an image
+    Args:
+        media: the file object of the image
+
+    Returns:
+        The int hash, or None if the image can't be decoded
+    """
+    try:
+        media.seek(0)
+        with Image.open(media) as image:
+            pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    except (OSError, ValueError):
+        return None
+
+    image_hash = 0
+    for row in range(8):
+        for col in range(8):
+            left, right = pixels[row * 9 + col], pixels[row * 9 + col + 1]
+            image_hash = image_hash << 1 | (left > right)
+
+    return image_hash
+
+
+# Built by load_phash_index at startup rather than on import, as it needs numpy
+phash_index = None
+last_sync = None
+
+
+def load_phash_index():
+    """
+    Load the hashes of known unsafe images from disk, or from the storage if there
+    is no index on disk yet
+
+    Returns:
+        None
+    """
+    global phash_index, last_sync
+    if os.path.exists(PHASH_INDEX_FILE):
+        phash_index = PHashIndex(np.fromfile(PHASH_INDEX_FILE, dtype="<u8"))
+
+        # Without a sync time, pull all the hashes and skip the ones already known
+        if os.path.exists(PHASH_SYNC_FILE):
+            with open(PHASH_SYNC_FILE) as f:
+                last_sync = datetime.fromisoformat(f.read().strip())
+    else:
+        phash_index = PHashIndex()
+        sync_phash_index(None)
+
+
+def sync_phash_index(_):
+    """
+    Add the hashes of unsafe images flagged by other instances since the last sync
+    Args:
+        _: unused variable
+
+    Returns:
+        None
+    """
+    global last_sync
+    sync_time = datetime.utcnow()
+    hashes = storage.get_phashes(last_sync)
+    new_hashes = [x for x in hashes if not phash_index.find(x, 0)]
+
+    for image_hash in new_hashes:
+        phash_index.add(image_hash)
+
+    save_hashes(new_hashes)
+    last_sync = sync_time
+
+    tmp_name = f"{PHASH_SYNC_FILE}.tmp"
+    with open(tmp_name, "w") as f:
+        f.write(sync_time.isoformat())
+
+    os.replace(tmp_name, PHASH_SYNC_FILE)
+
+
+def find_unsafe_hash(image_hash):
+    return phash_index.find(image_hash)
+
+
+def add_unsafe_hash(image_hash):
+    """
+    Record the hash of an image that has been flagged as unsafe
+    Args:
+        image_hash: the int hash
+
+    Returns:
+        None
+    """
+    phash_index.add(image_hash)
+    save_hashes([image_hash])
+    storage.add_phash(image_hash, datetime.utcnow())
+
+
+def save_hashes(hashes):
+    if hashes:
+        with open(PHASH_INDEX_FILE, "ab") as f:
+            np.array(hashes, dtype="<u8").tofile(f)
@@ -1,41 +1,39 @@
-import os
-
-from azure.cognitiveservices.vision.contentmoderator import ContentModeratorClient
-from datetime import date
-from dotenv import load_dotenv
-from google.cloud import vision, datastore
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from logbook import Logger
-from msrest.authentication import CognitiveServicesCredentials
-from telegram import Chat, ChatAction
+from telegram import Chat
 
 from group_defender.constants import *
-from group_defender.utils import filter_msg, get_settings
-from group_defender.store import datastore_client
+from group_defender.defend.classifier import classify_locally
+from group_defender.defend.media import read_media
+from group_defender.defend.quota import gcp_ledger, azure_ledger
+from group_defender.lazy import lazy_import
+from group_defender.settings import get_setting
+from group_defender.utils import describe_file, filter_msg
 
-load_dotenv()
-AZURE_TOKEN = os.environ.get("AZURE_TOKEN")
-AZURE_LOC = os.environ.get("AZURE_LOC")
+contentmoderator = lazy_import("azure.cognitiveservices.vision.contentmoderator")
+msrest_auth = lazy_import("msrest.authentication")
+vision = lazy_import("google.cloud.vision")
 
-if AZURE_TOKEN is None:
-    AZURE_TOKEN, AZURE_LOC = get_settings(["AZURE_TOKEN", "AZURE_LOC"])
+azure_executor = ThreadPoolExecutor(max_workers=AZURE_WORKERS)
 
 
-def check_photo(update, context, file_id, file_name, file_type):
+def send_photo_verdict(update, context, file_id, file_type, is_safe, likelihood):
     """
-    Check if the photo is safe or not
+    Act on the verdict of a photo, sticker, animation or video, deleting it in groups
+    or replying in private chats
     Args:
         update: the update object
         context: the context object
         file_id: the int of the file ID
-        file_name: the string of the file name
         file_type: the string of the file type
+        is_safe: the bool indicating if the file is safe or not, None if not scanned
+        likelihood: the string of the likelihood of the file containing NSFW content
 
     Returns:
         None
     """
     message = update.effective_message
-    message.chat.send_action(ChatAction.TYPING)
-    is_safe, likelihood = scan_photo(file_name)
     chat_type = message.chat.type
 
     if is_safe is not None:
@@ -43,8 +41,8 @@ def check_photo(update, context, file_id, file_name, file_type):
             # Delete message if it is a group chat
             if chat_type in (Chat.GROUP, Chat.SUPERGROUP):
                 text = (
-                    f"I've deleted a photo that's {likelihood} to contain "
-                    f"NSFW content (sent by @{message.from_user.username})."
+                    f"I've deleted {describe_file(file_type)} that's {likelihood} to "
+                    f"contain NSFW content (sent by @{message.from_user.username})."
                 )
                 filter_msg(update, context, file_id, file_type, text)
             else:
@@ -58,83 +56,156 @@ def check_photo(update, context, file_id, file_name, file_type):
                 )
     else:
         if chat_type == Chat.PRIVATE:
-            message.reply_text("Photo scanning is currently unavailable.", quote=True)
+            message.reply_text(
+                f"{file_type.capitalize()} scanning is currently unavailable.",
+                quote=True,
+            )
 
-    return is_safe
 
+def scan_photo(media=None, file_url=None):
+    return scan_photos([media if media is not None else file_url])[0]
 
-def scan_photo(file_name=None, file_url=None):
-    curr_datetime = date.today()
-    curr_year = curr_datetime.year
-    curr_month = curr_datetime.month
 
-    query = datastore_client.query(kind=API_COUNT)
-    query.add_filter(YEAR, "=", curr_year)
-    query.add_filter(MONTH, "=", curr_month)
-    entities = {}
+def scan_photos(images):
+    """
+    Scan the photos with the local classifier first, and the rest with as few API
+    calls as possible
+    Args:
+        images: the list of file objects or string urls of the photos
+
+    Returns:
+        A list of tuples of a bool indicating if the photo is safe or not and the
+        likelihood, both None if the photo was not scanned
+    """
+    results = [(None, None)] * len(images)
+    remote_indices = []
+    gcp_indices = []
+    azure_indices = []
+
+    # Only escalate the images that the local classifier is not sure about
+    for i, image in enumerate(images):
+        verdict = None if isinstance(image, str) else classify_locally(image)
+        if verdict is None:
+            remote_indices.append(i)
+        else:
+            results[i] = verdict
 
-    for entity in query.fetch():
-        entities[entity[NAME]] = entity[COUNT]
+    for i in remote_indices:
+        if gcp_ledger.acquire():
+            gcp_indices.append(i)
+        elif azure_ledger.acquire():
+            azure_indices.append(i)
 
-    is_safe = likelihood = None
-    if GCP not in entities or entities[GCP] <= GCP_LIMIT:
-        is_safe, likelihood = gcp_scan(file_name, file_url)
-        update_api_count(datastore_client, GCP, curr_year, curr_month)
-    elif AZURE not in entities or entities[AZURE] <= AZURE_LIMIT:
-        is_safe, likelihood = azure_scan(file_name, file_url)
-        update_api_count(datastore_client, AZURE, curr_year, curr_month)
-    else:
+    if len(gcp_indices) + len(azure_indices) < len(remote_indices):
         log = Logger()
         log.warn("Vision scan tokens exhausted")
 
+    gcp_results = gcp_scan([images[i] for i in gcp_indices])
+    azure_results = azure_executor.map(azure_scan, [images[i] for i in azure_indices])
+
+    for i, result in zip(
+        gcp_indices + azure_indices, chain(gcp_results, azure_results)
+    ):
+        results[i] = result
+
+    return results
+
+
+def combine_verdicts(verdicts):
+    """
+    Combine the verdicts of the parts of one media, such as the frames of a video
+    Args:
+        verdicts: the list of tuples of a bool indicating if the part is safe or not
+            and the likelihood
+
+    Returns:
+        A tuple of a bool indicating if the media is safe or not and the highest
+        likelihood, both None if any part was not scanned
+    """
+    if not verdicts or any(x[0] is None for x in verdicts):
+        return None, None
+
+    is_safe = all(x[0] for x in verdicts)
+    likelihood = max((x[1] for x in verdicts), key=GCP_LIKELIHOODS.index)
+
     return is_safe, likelihood
 
 
-def gcp_scan(file_name=None, file_url=None):
+def gcp_scan(images):
     """
-        Scan the photo using the API
+        Scan the photos using the API, in batches of up to GCP_BATCH_SIZE photos
         Args:
-            file_name: the string of the file name
-            file_url: the string of the file url
+            images: the list of file objects or string urls of the photos
 
         Returns:
-            A tuple of a bool indicating if the photo is safe or not and the results from the API call
+            A list of tuples of a bool indicating if the photo is safe or not and the
+            likelihood
         """
-    if file_name is not None:
-        img_src = {"content": open(file_name, "rb").read()}
-    else:
-        img_src = {"source": {"image_uri": file_url}}
+    if not images:
+        return []
 
     client = vision.ImageAnnotatorClient()
-    response = client.annotate_image(
-        {
-            "image": img_src,
-            "features": [{"type": vision.enums.Feature.Type.SAFE_SEARCH_DETECTION}],
-        }
-    )
+    results = []
 
-    safe_ann = response.safe_search_annotation
-    results = [safe_ann.adult, safe_ann.medical, safe_ann.violence, safe_ann.racy]
-    is_safe = all(x < GCP_THRESHOLD for x in results)
+    for i in range(0, len(images), GCP_BATCH_SIZE):
+        requests = []
+        for image in images[i : i + GCP_BATCH_SIZE]:
+            if isinstance(image, str):
+                img_src = {"source": {"image_uri": image}}
+            else:
+                img_src = {"content": read_media(image)}
+
+            requests.append(
+                {
+                    "image": img_src,
+                    "features": [
+                        {"type": vision.enums.Feature.Type.SAFE_SEARCH_DETECTION}
+                    ],
+                }
+            )
+
+        response = client.batch_annotate_images(requests)
+        for image_response in response.responses:
+            if image_response.error.code:
+                results.append((None, None))
+            else:
+                safe_ann = image_response.safe_search_annotation
+                scores = [
+                    safe_ann.adult,
+                    safe_ann.medical,
+                    safe_ann.violence,
+                    safe_ann.racy,
+                ]
+                is_safe = all(x < GCP_THRESHOLD for x in scores)
+                results.append((is_safe, GCP_LIKELIHOODS[max(scores)]))
 
-    return is_safe, GCP_LIKELIHOODS[max(results)]
+    return results
 
 
-def azure_scan(file_name=None, file_url=None):
-    client = ContentModeratorClient(
-        f"https://{AZURE_LOC}.api.cognitive.microsoft.com/",
-        CognitiveServicesCredentials(AZURE_TOKEN),
+def azure_scan(image):
+    """
+    Scan the photo using the API
+    Args:
+        image: the file object or string url of the photo
+
+    Returns:
+        A tuple of a bool indicating if the photo is safe or not and the likelihood
+    """
+    client = contentmoderator.ContentModeratorClient(
+        f'https://{get_setting("AZURE_LOC")}.api.cognitive.microsoft.com/',
+        msrest_auth.CognitiveServicesCredentials(get_setting("AZURE_TOKEN")),
     )
-    if file_name is not None:
-        evaluation = client.image_moderation.evaluate_file_input(
-            image_stream=open(file_name, "rb"), cache_image=True
-        )
-    else:
+    if isinstance(image, str):
         evaluation = client.image_moderation.evaluate_url_input(
             content_type="application/json",
             cache_image=True,
             data_representation="URL",
-            value=file_url,
+            value=image,
+        )
+    else:
+        image.seek(0)
+        evaluation = client.image_moderation.evaluate_file_input(
+            image_stream=image, cache_image=True
         )
 
     results = [
@@ -156,18 +227,3 @@ def azure_scan(file_name=None, file_url=None):
         likelihood = "very unlikely"
 
     return is_safe, likelihood
-
-
-def update_api_count(client, name, curr_year, curr_month):
-    with client.transaction():
-        key = client.key(API_COUNT, f"{name}{curr_year}{curr_month}")
-        entity = client.get(key)
-
-        if entity is None:
-            entity = datastore.Entity(key)
-            count = 1
-        else:
-            count = entity[COUNT] + 1
-
-        entity.update({NAME: name, COUNT: count, YEAR: curr_year, MONTH: curr_month})
-        client.put(entity)
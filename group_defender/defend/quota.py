@@ -0,0 +1,113 @@
+import threading
+
+from datetime import date
+
+from group_defender.constants import (
+    API_LEASE_SIZE,
+    AZURE,
+    AZURE_LIMIT,
+    GCP,
+    GCP_LIMIT,
+)
+from group_defender.storage import storage
+
+
+class QuotaLedger:
+    """
+    A local share of the monthly API budget of a provider
+
+    Blocks of the budget are leased from the provider's monthly API counter, which
+    counts every call that has been leased by any instance, so the instances
+    together can never go over the limit. Calls are then taken from the lease in
+    memory without touching the storage.
+    """
+
+    def __init__(self, name, limit, lease_size):
+        """
+        Args:
+            name: the string of the provider name
+            limit: the int of the monthly number of calls
+            lease_size: the int of the number of calls to lease at a time
+        """
+        self.name = name
+        self.limit = limit
+        self.lease_size = lease_size
+        self.remaining = 0
+        self.period = None
+        self.exhausted = False
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one call from the budget, leasing a new block if needed
+        Returns:
+            A bool indicating if the call can be made
+        """
+        with self._lock:
+            period = current_period()
+            if period != self.period:
+                self.period = period
+                self.remaining = 0
+                self.exhausted = False
+
+            if self.remaining == 0 and not self.exhausted:
+                self.remaining = self._update_count(self.lease_size)
+                self.exhausted = self.remaining == 0
+
+            if self.remaining == 0:
+                return False
+
+            self.remaining -= 1
+
+            return True
+
+    def release(self):
+        """
+        Give the unused calls of the lease back to the shared budget, and allow
+        the budget to be checked again if it was exhausted
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if self.period == current_period() and self.remaining > 0:
+                self._update_count(-self.remaining)
+
+            self.remaining = 0
+            self.exhausted = False
+
+    def _update_count(self, delta):
+        """
+        Lease or give back calls on the API counter of the current period
+        Args:
+            delta: the int of the number of calls, negative to give them back
+
+        Returns:
+            The int of the number of calls that were actually leased
+        """
+        year, month = self.period
+
+        return storage.update_api_count(self.name, year, month, delta, self.limit)
+
+
+def current_period():
+    today = date.today()
+
+    return today.year, today.month
+
+
+gcp_ledger = QuotaLedger(GCP, GCP_LIMIT, API_LEASE_SIZE)
+azure_ledger = QuotaLedger(AZURE, AZURE_LIMIT, API_LEASE_SIZE)
+
+
+def reconcile_api_counts(_):
+    """
+    Give the unused leases back so that idle instances don't hold on to the budget
+    Args:
+        _: unused variable
+
+    Returns:
+        None
+    """
+    for ledger in (gcp_ledger, azure_ledger):
+        ledger.release()
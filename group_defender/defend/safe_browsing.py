@@ -0,0 +1,499 @@
+import base64
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import re
+import requests
+import socket
+import time
+
+from dotenv import load_dotenv
+from logbook import Logger
+from urllib.parse import unquote_to_bytes
+
+from group_defender.cache import TTLCache
+from group_defender.constants import (
+    SAFE_BROWSING_API,
+    SAFE_BROWSING_THREAT_TYPES,
+    SAFE_BROWSING_FULL_HASH_TTL,
+    SAFE_BROWSING_CACHE_SIZE,
+    TIMEOUT,
+)
+from group_defender.settings import get_setting
+
+load_dotenv()
+SAFE_BROWSING_DB = os.environ.get("SAFE_BROWSING_DB")
+SAFE_BROWSING_API = os.environ.get("SAFE_BROWSING_API", SAFE_BROWSING_API)
+
+CLIENT = {"clientId": "group-defender", "clientVersion": "1.0"}
+PLATFORM_TYPE = "ANY_PLATFORM"
+THREAT_ENTRY_TYPE = "URL"
+
+prefix_stores = {}
+retired_stores = []
+full_hash_cache = TTLCache(SAFE_BROWSING_CACHE_SIZE, SAFE_BROWSING_FULL_HASH_TTL)
+next_update_time = 0
+
+
+class PrefixStore:
+    """
+    The sorted hash prefixes of a threat list, packed into one blob per prefix size
+    """
+
+    def __init__(self, blobs=None, state="", mm=None):
+        """
+        Args:
+            blobs: the dict of prefix sizes to bytes-like objects of sorted prefixes
+            state: the string of the client state of the list
+            mm: the memory map that the blobs are views of, if any
+        """
+        self.blobs = blobs or {}
+        self.state = state
+        self.mm = mm
+
+    def __len__(self):
+        return sum(len(blob) // size for size, blob in self.blobs.items())
+
+    def __contains__(self, full_hash):
+        return self.match(full_hash) is not None
+
+    def match(self, full_hash):
+        """
+        Find the prefix of the full hash in the store
+        Args:
+            full_hash: the bytes of the SHA-256 hash
+
+        Returns:
+            The bytes of the matching prefix or None if there is no match
+        """
+        for size, blob in self.blobs.items():
+            prefix = full_hash[:size]
+            lo, hi = 0, len(blob) // size
+
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if bytes(blob[mid * size : (mid + 1) * size]) < prefix:
+                    lo = mid + 1
+                else:
+                    hi = mid
+
+            if bytes(blob[lo * size : (lo + 1) * size]) == prefix:
+                return prefix
+
+        return None
+
+    def prefixes(self):
+        """
+        Iterate over all the prefixes in lexicographic order, which is the order
+        that the removal indices of partial updates refer to
+        """
+        iters = []
+        for size, blob in self.blobs.items():
+            iters.append(bytes(blob[i : i + size]) for i in range(0, len(blob), size))
+
+        return heapq.merge(*iters)
+
+    def update(self, response):
+        """
+        Apply an update response of the threat list
+        Args:
+            response: the dict of the list update response
+
+        Returns:
+            A new prefix store with the update applied, or None if the checksum of
+            the updated list does not match
+        """
+        if response["responseType"] == "FULL_UPDATE":
+            prefixes = []
+        else:
+            removals = set()
+            for removal in response.get("removals", []):
+                removals.update(removal["rawIndices"]["indices"])
+
+            prefixes = [x for i, x in enumerate(self.prefixes()) if i not in removals]
+
+        for addition in response.get("additions", []):
+            size = addition["rawHashes"]["prefixSize"]
+            raw = base64.b64decode(addition["rawHashes"]["rawHashes"])
+            prefixes.extend(raw[i : i + size] for i in range(0, len(raw), size))
+
+        prefixes.sort()
+        checksum = hashlib.sha256(b"".join(prefixes)).digest()
+
+        if checksum != base64.b64decode(response["checksum"]["sha256"]):
+            return None
+
+        blobs = {}
+        for prefix in prefixes:
+            blobs.setdefault(len(prefix), bytearray()).extend(prefix)
+
+        return PrefixStore(
+            {k: bytes(v) for k, v in blobs.items()}, response["newClientState"]
+        )
+
+    def save(self, file_name):
+        """
+        Write the store to disk, replacing any existing file atomically
+        Args:
+            file_name: the string of the file name
+
+        Returns:
+            None
+        """
+        header = {
+            "state": self.state,
+            "sizes": [[size, len(blob)] for size, blob in self.blobs.items()],
+        }
+        tmp_name = f"{file_name}.tmp"
+
+        with open(tmp_name, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            for blob in self.blobs.values():
+                f.write(blob)
+
+        os.replace(tmp_name, file_name)
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Memory-map a store written by save
+        Args:
+            file_name: the string of the file name
+
+        Returns:
+            The prefix store
+        """
+        with open(file_name, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header_end = mm.find(b"\n") + 1
+        header = json.loads(mm[:header_end])
+        view = memoryview(mm)
+        blobs = {}
+        offset = header_end
+
+        for size, length in header["sizes"]:
+            blobs[size] = view[offset : offset + length]
+            offset += length
+
+        return cls(blobs, header["state"], mm)
+
+    def close(self):
+        """
+        Release the memory map of a loaded store, the store can't be used after
+
+        Returns:
+            None
+        """
+        if self.mm is None:
+            return
+
+        for blob in self.blobs.values():
+            blob.release()
+
+        self.mm.close()
+        self.mm = None
+
+
+def canonicalize_url(url):
+    """
+    Canonicalize the url as specified by the Safe Browsing API
+    Args:
+        url: the string or the bytes of the url
+
+    Returns:
+        The string of the canonicalized url
+    """
+    raw = url if isinstance(url, bytes) else url.encode()
+    raw = re.sub(rb"[\t\r\n]", b"", raw.strip()).split(b"#", 1)[0]
+    if not re.match(rb"^[a-zA-Z][a-zA-Z0-9+.-]*://", raw):
+        raw = b"http://" + raw
+
+    while True:
+        unquoted = unquote_to_bytes(raw)
+        if unquoted == raw:
+            break
+
+        raw = unquoted
+
+    scheme, rest = raw.split(b"://", 1)
+    host_end = len(rest)
+
+    for sep in (b"/", b"?"):
+        index = rest.find(sep)
+        if index != -1:
+            host_end = min(host_end, index)
+
+    host, path = rest[:host_end], rest[host_end:]
+    host = host.rsplit(b"@", 1)[-1].split(b":", 1)[0].lower()
+    host = re.sub(rb"\.+", b".", host).strip(b".")
+    host = parse_ipv4(host) or host
+
+    path, sep, query = path.partition(b"?")
+    segments = []
+
+    for segment in path.split(b"/"):
+        if segment == b"..":
+            if segments:
+                segments.pop()
+        elif segment not in (b"", b"."):
+            segments.append(segment)
+
+    trailing = path.endswith((b"/", b"/.", b"/..")) and segments
+    path = b"/" + b"/".join(segments) + (b"/" if trailing else b"")
+
+    return (
+        f"{scheme.decode().lower()}://{escape(host)}{escape(path)}"
+        f"{sep.decode()}{escape(query)}"
+    )
+
+
+def parse_ipv4(host):
+    """
+    Parse the host as an IPv4 address in any of the forms accepted by inet_aton,
+    with one to four decimal, octal or hex parts
+    Args:
+        host: the bytes of the host
+
+    Returns:
+        The bytes of the address in dotted decimal form, None if the host is not an
+        IPv4 address
+    """
+    parts = host.split(b".")
+    if len(parts) > 4:
+        return None
+
+    nums = []
+    for part in parts:
+        match = re.fullmatch(rb"0[xX]([0-9a-fA-F]*)|(0[0-7]*)|([1-9][0-9]*)", part)
+        if match is None:
+            return None
+
+        hex_num, oct_num, dec_num = match.groups()
+        if hex_num is not None:
+            nums.append(int(hex_num or b"0", 16))
+        elif oct_num is not None:
+            nums.append(int(oct_num, 8))
+        else:
+            nums.append(int(dec_num))
+
+    # The last part fills the bytes that the other parts leave
+    if any(x > 255 for x in nums[:-1]) or nums[-1] >= 256 ** (5 - len(nums)):
+        return None
+
+    address = nums[-1]
+    for i, num in enumerate(nums[:-1]):
+        address += num << (8 * (3 - i))
+
+    return socket.inet_ntoa(address.to_bytes(4, "big")).encode()
+
+
+def escape(raw):
+    return "".join(
+        f"%{x:02X}" if x <= 32 or x >= 127 or x in b"#%" else chr(x) for x in raw
+    )
+
+
+def url_expressions(url):
+    """
+    Get the host suffix and path prefix expressions of the url
+    Args:
+        url: the string of the url
+
+    Returns:
+        A list of the string expressions
+    """
+    rest = canonicalize_url(url).split("://", 1)[1]
+    host, slash, path = rest.partition("/")
+    path = slash + path
+    hosts = [host]
+
+    if not re.match(r"^\d+\.\d+\.\d+\.\d+$", host):
+        parts = host.split(".")
+        for i in range(min(len(parts) - 1, 5), 1, -1):
+            hosts.append(".".join(parts[-i:]))
+
+    path_only, has_query, _ = path.partition("?")
+    paths = [path] if has_query else []
+    paths.extend([path_only, "/"])
+    prefix = "/"
+
+    for segment in path_only.split("/")[1:-1][:3]:
+        prefix += f"{segment}/"
+        paths.append(prefix)
+
+    expressions = []
+    for host in hosts:
+        for path in paths:
+            expression = f"{host}{path}"
+            if expression not in expressions:
+                expressions.append(expression)
+
+    return expressions
+
+
+def url_hashes(url):
+    return [hashlib.sha256(x.encode()).digest() for x in url_expressions(url)]
+
+
+def scan_url_local(urls):
+    """
+    Scan the url using the local hash prefix database, only looking up the full
+    hashes of the urls with a matching prefix
+    Args:
+        urls: the list of urls
+
+    Returns:
+        A tuple of a bool indicating if all the urls are safe and a list indicating
+        the safeness of individual urls
+    """
+    url_hash_list = [url_hashes(url) for url in urls]
+    prefixes = set()
+
+    for hashes in url_hash_list:
+        for full_hash in hashes:
+            for store in prefix_stores.values():
+                prefix = store.match(full_hash)
+                if prefix is not None:
+                    prefixes.add(prefix)
+
+    try:
+        unsafe_hashes = get_full_hashes(prefixes) if prefixes else set()
+    except requests.RequestException as e:
+        # Let the links through unverified rather than failing the check
+        Logger().warn(f"Failed to look up Safe Browsing full hashes: {e}")
+        unsafe_hashes = set()
+    safe_list = [not unsafe_hashes.intersection(x) for x in url_hash_list]
+
+    return all(safe_list), safe_list
+
+
+def get_full_hashes(prefixes):
+    """
+    Get the unsafe full hashes matching the prefixes, using the cache if possible
+    Args:
+        prefixes: the set of the bytes prefixes
+
+    Returns:
+        A set of the bytes full hashes
+    """
+    full_hashes = set()
+    missing = []
+
+    for prefix in prefixes:
+        cached = full_hash_cache.get(prefix)
+        if cached is None:
+            missing.append(prefix)
+        else:
+            full_hashes.update(cached)
+
+    if not missing:
+        return full_hashes
+
+    data = {
+        "client": CLIENT,
+        "clientStates": [x.state for x in prefix_stores.values()],
+        "threatInfo": {
+            "threatTypes": SAFE_BROWSING_THREAT_TYPES,
+            "platformTypes": [PLATFORM_TYPE],
+            "threatEntryTypes": [THREAT_ENTRY_TYPE],
+            "threatEntries": [{"hash": base64.b64encode(x).decode()} for x in missing],
+        },
+    }
+    r = requests.post(
+        f"{SAFE_BROWSING_API}/fullHashes:find",
+        params={"key": get_setting("GOOGLE_TOKEN")},
+        json=data,
+        timeout=TIMEOUT,
+    )
+    r.raise_for_status()
+
+    matches = {prefix: set() for prefix in missing}
+    for match in r.json().get("matches", []):
+        full_hash = base64.b64decode(match["threat"]["hash"])
+        for prefix in missing:
+            if full_hash.startswith(prefix):
+                matches[prefix].add(full_hash)
+
+    for prefix, hashes in matches.items():
+        full_hash_cache.set(prefix, hashes)
+        full_hashes.update(hashes)
+
+    return full_hashes
+
+
+def load_hash_prefixes():
+    """
+    Load the hash prefix stores saved on disk
+
+    Returns:
+        None
+    """
+    os.makedirs(SAFE_BROWSING_DB, exist_ok=True)
+    for threat_type in SAFE_BROWSING_THREAT_TYPES:
+        file_name = os.path.join(SAFE_BROWSING_DB, f"{threat_type}.bin")
+        if os.path.exists(file_name):
+            prefix_stores[threat_type] = PrefixStore.load(file_name)
+
+
+def update_hash_prefixes(_):
+    """
+    Fetch the threat list updates and apply them to the hash prefix stores
+    Args:
+        _: unused variable
+
+    Returns:
+        None
+    """
+    global next_update_time
+    if time.time() < next_update_time:
+        return
+
+    # Close the stores replaced by the last update, which scans in flight may have
+    # still been reading at the time
+    while retired_stores:
+        retired_stores.pop().close()
+
+    data = {
+        "client": CLIENT,
+        "listUpdateRequests": [
+            {
+                "threatType": threat_type,
+                "platformType": PLATFORM_TYPE,
+                "threatEntryType": THREAT_ENTRY_TYPE,
+                "state": prefix_stores.get(threat_type, PrefixStore()).state,
+                "constraints": {"supportedCompressions": ["RAW"]},
+            }
+            for threat_type in SAFE_BROWSING_THREAT_TYPES
+        ],
+    }
+    r = requests.post(
+        f"{SAFE_BROWSING_API}/threatListUpdates:fetch",
+        params={"key": get_setting("GOOGLE_TOKEN")},
+        json=data,
+        timeout=TIMEOUT,
+    )
+    r.raise_for_status()
+    results = r.json()
+    log = Logger()
+
+    for response in results.get("listUpdateResponses", []):
+        threat_type = response["threatType"]
+        store = prefix_stores.get(threat_type, PrefixStore()).update(response)
+
+        # Start over with a full update next time if the list got out of sync
+        if store is None:
+            log.warn(f"Safe Browsing list {threat_type} checksum mismatch")
+            store = PrefixStore()
+        else:
+            store.save(os.path.join(SAFE_BROWSING_DB, f"{threat_type}.bin"))
+
+        if threat_type in prefix_stores:
+            retired_stores.append(prefix_stores[threat_type])
+
+        prefix_stores[threat_type] = store
+
+    wait_duration = results.get("minimumWaitDuration", "0s")
+    next_update_time = time.time() + float(wait_duration.rstrip("s"))
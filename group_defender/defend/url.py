@@ -1,28 +1,54 @@
-import inflect
+import asyncio
 import mimetypes
-import os
 import re
-import requests
 
-from dotenv import load_dotenv
+from logbook import Logger
 from telegram import Chat, ChatAction, ChatMember, MessageEntity
-from telegram.ext.dispatcher import run_async
-
-from group_defender.constants import URL
+from urllib.parse import urlsplit, urlunsplit
+
+from group_defender.aio import get_http_client, reply_text, send_chat_action
+from group_defender.batch import AsyncMicroBatcher, SingleFlight
+from group_defender.constants import (
+    URL,
+    HTTP_SAFE_BROWSING_CONNECTIONS,
+    SAFE_BROWSING_BATCH_WINDOW,
+    SAFE_BROWSING_MAX_ENTRIES,
+    TIMEOUT,
+    URL_PROBE_CONNECTIONS,
+    URL_PROBE_TIMEOUT,
+    URL_PROBE_DEADLINE,
+)
+from group_defender.defend.campaign import (
+    add_recent_msg,
+    campaign_sender,
+    flag_campaign,
+    is_flagged,
+    remove_campaign_msg,
+    url_key,
+)
 from group_defender.defend.file import scan_file
 from group_defender.defend.photo import scan_photo
-from group_defender.utils import filter_msg, get_setting
+from group_defender.defend.safe_browsing import (
+    SAFE_BROWSING_API,
+    SAFE_BROWSING_DB,
+    scan_url_local,
+)
+from group_defender.core import async_handler, cheap_checks, run_blocking
+from group_defender.lazy import lazy_import
+from group_defender.members import fetch_member_status
+from group_defender.settings import get_setting
+from group_defender.utils import filter_msg, send_cheap_notice
 from group_defender.stats import update_stats
 
-load_dotenv()
-GOOGLE_TOKEN = os.environ.get("GOOGLE_TOKEN")
+httpx = lazy_import("httpx")
+inflect = lazy_import("inflect")
 
-if GOOGLE_TOKEN is None:
-    GOOGLE_TOKEN = get_setting("GOOGLE_TOKEN")
+# The same link sent to many chats at once is only probed and scanned once
+url_flights = SingleFlight("links")
 
 
-@run_async
-def check_url(update, context):
+@async_handler()
+async def check_url(update, context):
     """
     Check if the url is safe or not
     Args:
@@ -36,27 +62,60 @@ def check_url(update, context):
     message = update.effective_message
     if (
         message.chat.type in (Chat.GROUP, Chat.SUPERGROUP)
-        and message.chat.get_member(context.bot.id).status != ChatMember.ADMINISTRATOR
+        and await fetch_member_status(context.bot, message.chat_id, context.bot.id)
+        != ChatMember.ADMINISTRATOR
     ):
-        message.reply_text(
-            "Set me as a group admin so that I can start checking links like this."
+        await reply_text(
+            message,
+            "Set me as a group admin so that I can start checking links like this.",
         )
 
         return
 
-    message.chat.send_action(ChatAction.TYPING)
     entities = message.parse_entities([MessageEntity.URL])
-    urls = entities.values()
-    active_urls = get_active_urls(urls)
-    is_url_safe, safe_list = scan_url(active_urls)
+    urls = list(entities.values())
+
+    # Remove the links that have already been flagged in a group without checking
+    # them again
+    is_group = message.chat.type in (Chat.GROUP, Chat.SUPERGROUP)
+    campaign_keys = [url_key(canonical_url(x)) for x in urls]
+
+    if is_group and is_flagged(campaign_sender(message), campaign_keys):
+        await run_blocking(remove_campaign_msg, update, context, None, URL)
+
+        return
+
+    # The chat is sending more than its share, so skip probing the links and
+    # scanning the photos behind them, and only look them up in Safe Browsing
+    cheap = cheap_checks.get()
+    if cheap:
+        send_cheap_notice(update)
+        active_urls = urls
+    else:
+        _, active_urls = await asyncio.gather(
+            send_chat_action(context.bot, message.chat_id, ChatAction.TYPING),
+            get_active_urls(urls),
+        )
+
+    is_url_safe, safe_list = await scan_url(active_urls)
     is_file_safe = is_photo_safe = True
+    checked_urls = active_urls
 
-    if is_url_safe:
-        message.chat.send_action(ChatAction.TYPING)
-        is_file_safe, is_photo_safe, safe_list = check_file_photo(urls)
+    if is_url_safe and not cheap:
+        _, (is_file_safe, is_photo_safe, safe_list) = await asyncio.gather(
+            send_chat_action(context.bot, message.chat_id, ChatAction.TYPING),
+            check_file_photo(urls),
+        )
+        checked_urls = urls
 
     chat_type = message.chat.type
+    blocked = None
+
+    # The links found unsafe, by their canonical urls as the active urls already are
+    unsafe_urls = {canonical_url(x) for x, y in zip(checked_urls, safe_list) if not y}
+
     if not is_url_safe or not is_file_safe or not is_photo_safe:
+        blocked = {URL: safe_list.count(False)}
         if not is_photo_safe:
             content = "NSFW content"
         else:
@@ -67,65 +126,155 @@ def check_url(update, context):
                 f"I've deleted a message that contains links with {content} "
                 f"(sent by @{message.from_user.username})."
             )
-            filter_msg(update, context, None, URL, text)
+            await run_blocking(filter_msg, update, context, None, URL, text)
         else:
             ordinals = []
             p = inflect.engine()
 
-            for i, is_link_safe in enumerate(safe_list):
-                if not is_link_safe:
+            for i, url in enumerate(urls):
+                if canonical_url(url) in unsafe_urls:
                     ordinals.append(p.ordinal(i + 1))
 
             if len(urls) == 1:
-                message.reply_text(
-                    f"I think the link contains {content}, don't open it.", quote=True
-                )
+                text = f"I think the link contains {content}, don't open it."
             else:
-                message.reply_text(
+                text = (
                     f'I think the {", ".join(ordinals)} links contain a virus or '
-                    f"malware or NSFW content, don't open them.",
-                    quote=True,
+                    f"malware or NSFW content, don't open them."
                 )
+
+            await reply_text(message, text, quote=True)
     else:
         if chat_type == Chat.PRIVATE:
             if len(active_urls) == 0:
-                message.reply_text(
-                    "I couldn't check the link(s) as they are unavailable.", quote=True
-                )
+                text = "I couldn't check the link(s) as they are unavailable."
             else:
-                message.reply_text("I think the link(s) are safe.", quote=True)
+                text = "I think the link(s) are safe."
 
-    update_stats(message.chat_id, {URL: len(active_urls)})
+            await reply_text(message, text, quote=True)
 
+    if is_group and blocked:
+        flag_campaign(
+            message.chat_id,
+            campaign_sender(message),
+            [url_key(x) for x in unsafe_urls],
+        )
+    elif is_group:
+        add_recent_msg(update, context, None, URL, campaign_keys)
+
+    update_stats(message.chat_id, {URL: len(active_urls)}, blocked)
 
-def get_active_urls(urls):
+
+async def get_active_urls(urls):
     """
-    Get a list of urls with an OK status
+    Get a list of urls without the ones that answered with an error status
     Args:
         urls: the list of urls
 
     Returns:
-        A list of urls
+        A list of urls, including the ones that were unreachable or not probed in
+        time, so that they are still looked up
     """
-    active_urls = []
-    for url in urls:
-        if url.startswith("https://"):
-            url = re.sub(r"^https://", "http://", url)
-        elif not url.startswith("http://"):
-            url = f"http://{url}"
+    probe_list = [canonical_url(x) for x in urls]
 
-        try:
-            r = requests.get(url)
-            if r.status_code == 200:
-                active_urls.append(url)
-        except requests.exceptions.ConnectionError:
-            continue
+    statuses = await probe_urls(probe_list)
+    active_urls = [
+        url for url, status in zip(probe_list, statuses) if status in (None, 200)
+    ]
 
     return active_urls
 
 
+def normalize_url(url):
+    """
+    Normalize the url so that the same link written differently has the same key
+    Args:
+        url: the string of the url
+
+    Returns:
+        The string of the url with a lowercase scheme and host, and without the
+        default port and the fragment
+    """
+    if re.match(r"^[a-z][a-z0-9+.-]*://", url, re.IGNORECASE) is None:
+        url = f"http://{url}"
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+
+    if (scheme, port) in (("http", 80), ("https", 443)):
+        netloc = netloc.rsplit(":", 1)[0]
+
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+def canonical_url(url):
+    """
+    Get the form of the url that links are probed and looked up by
+    Args:
+        url: the string of the url
+
+    Returns:
+        The string of the normalized url over http
+    """
+    return re.sub(r"^https://", "http://", normalize_url(url))
+
+
+async def probe_urls(urls):
+    """
+    Probe the urls concurrently, no longer waiting for the ones that are still
+    pending when the per-message deadline is reached
+    Args:
+        urls: the list of urls
+
+    Returns:
+        A list of the status codes of the urls, None if a url is unreachable or its
+        probe did not finish in time
+    """
+    if not urls:
+        return []
+
+    tasks = [url_flights.create_task(("probe", url), probe_url, url) for url in urls]
+
+    # The probes are left running rather than cancelled, as other messages with the
+    # same urls may be waiting for them
+    done, _ = await asyncio.wait(tasks, timeout=URL_PROBE_DEADLINE)
+
+    return [x.result() if x in done else None for x in tasks]
+
+
+async def probe_url(url):
+    """
+    Get the status code of the url without downloading its content
+    Args:
+        url: the string of the url
+
+    Returns:
+        The int of the status code, None if the url is unreachable
+    """
+    client = get_http_client("probe", URL_PROBE_CONNECTIONS)
+    try:
+        r = await client.head(url, follow_redirects=True, timeout=URL_PROBE_TIMEOUT)
+
+        # Some servers don't support HEAD requests, stop reading after the headers
+        if r.status_code in (405, 501):
+            async with client.stream(
+                "GET", url, follow_redirects=True, timeout=URL_PROBE_TIMEOUT
+            ) as r:
+                pass
+
+        return r.status_code
+    except (httpx.HTTPError, httpx.InvalidURL):
+        return None
+
+
 # Check if url is safe
-def scan_url(urls):
+async def scan_url(urls):
     """
     Scan the url using the API
     Args:
@@ -135,76 +284,103 @@ def scan_url(urls):
         A tuple of a bool indicating if all the urls are safe and a list indicating
         the safeness of individual urls
     """
-    is_safe = True
-    safe_list = [True] * len(urls)
-
-    safe_browsing_url = "https://safebrowsing.googleapis.com/v4/threatMatches:find"
-    params = {"key": GOOGLE_TOKEN}
-    json = {
-        "threatInfo": {
-            "threatTypes": [
-                "THREAT_TYPE_UNSPECIFIED",
-                "MALWARE",
-                "SOCIAL_ENGINEERING",
-                "UNWANTED_SOFTWARE",
-                "POTENTIALLY_HARMFUL_APPLICATION",
-            ],
-            "platformTypes": ["ANY_PLATFORM"],
-            "threatEntryTypes": ["URL"],
-            "threatEntries": [{"url": url} for url in urls],
+    if SAFE_BROWSING_DB is not None:
+        return await run_blocking(scan_url_local, urls)
+
+    safe_list = await url_batcher.submit(urls)
+
+    return all(safe_list), safe_list
+
+
+async def lookup_urls(urls):
+    """
+    Look up a batch of urls collected across messages using the API
+    Args:
+        urls: the list of urls
+
+    Returns:
+        A list indicating the safeness of individual urls
+    """
+    unique_urls = list(dict.fromkeys(urls))
+    unsafe_urls = set()
+
+    client = get_http_client("safe_browsing", HTTP_SAFE_BROWSING_CONNECTIONS)
+    safe_browsing_url = f"{SAFE_BROWSING_API}/threatMatches:find"
+    params = {"key": get_setting("GOOGLE_TOKEN")}
+
+    for i in range(0, len(unique_urls), SAFE_BROWSING_MAX_ENTRIES):
+        json = {
+            "threatInfo": {
+                "threatTypes": [
+                    "THREAT_TYPE_UNSPECIFIED",
+                    "MALWARE",
+                    "SOCIAL_ENGINEERING",
+                    "UNWANTED_SOFTWARE",
+                    "POTENTIALLY_HARMFUL_APPLICATION",
+                ],
+                "platformTypes": ["ANY_PLATFORM"],
+                "threatEntryTypes": ["URL"],
+                "threatEntries": [
+                    {"url": url}
+                    for url in unique_urls[i : i + SAFE_BROWSING_MAX_ENTRIES]
+                ],
+            }
         }
-    }
-    r = requests.post(safe_browsing_url, params=params, json=json)
+        try:
+            r = await client.post(
+                safe_browsing_url, params=params, json=json, timeout=TIMEOUT
+            )
+        except httpx.HTTPError as e:
+            # Let the links through unverified rather than failing every message
+            # in the batch
+            Logger().warn(f"Failed to look up urls in Safe Browsing: {e}")
+            continue
 
-    if r.status_code == 200:
-        results = r.json()
-        if "matches" in results and results["matches"]:
-            is_safe = False
-            matches = results["matches"]
-            urls_dict = {k: v for v, k in enumerate(urls)}
+        if r.status_code == 200:
+            for match in r.json().get("matches", []):
+                unsafe_urls.add(match["threat"]["url"])
 
-            for match in matches:
-                safe_list[urls_dict[match["threat"]["url"]]] = False
+    return [url not in unsafe_urls for url in urls]
 
-    return is_safe, safe_list
 
+url_batcher = AsyncMicroBatcher(
+    lookup_urls, SAFE_BROWSING_BATCH_WINDOW, SAFE_BROWSING_MAX_ENTRIES
+)
 
-def check_file_photo(urls):
+
+async def check_file_photo(urls):
     """
-    Check if the urls lead to a file or photo and if they are safe
+    Check if the urls lead to a file or photo and if they are safe, waiting for the
+    scan in flight of the same photo without holding a thread
     Args:
         urls: the list of urls
 
     Returns:
         A tuple of a bool indicating if the file is safe if exists, a bool indicating
-        if the photo is safe if exists, and a list indicating the safeness of individual urls
+        if the photo is safe if exists, and a list indicating the safeness of each url
     """
     is_file_safe = is_photo_safe = True
-    file_safe_list = [True] * len(urls)
-    photo_safe_list = []
+    safe_list = []
 
+    # One entry for each url in order, so that they line up with the urls
     for url in urls:
+        is_link_safe = True
         mime_type = mimetypes.guess_type(url)[0]
         if mime_type is not None:
             if mime_type.startswith("image"):
-                if not scan_photo(file_url=url)[0]:
-                    is_photo_safe = False
-                    photo_safe_list.append(False)
-                else:
-                    photo_safe_list.append(True)
+                is_safe, _ = await url_flights.run(
+                    ("photo", normalize_url(url)),
+                    run_blocking,
+                    scan_photo,
+                    file_url=url,
+                )
+                if not is_safe:
+                    is_photo_safe = is_link_safe = False
 
-            # if is_photo_safe:
+            # if is_link_safe:
             #     if not scan_file(file_url=url)[0]:
-            #         is_file_safe = False
-            #         file_safe_list.append(False)
-            #     else:
-            #         file_safe_list.append(True)
-            # else:
-            #     file_safe_list = [True] * len(urls)
-
-    if not is_file_safe or not is_photo_safe:
-        safe_list = [a if not a else b for a, b in zip(file_safe_list, photo_safe_list)]
-    else:
-        safe_list = [True] * len(urls)
+            #         is_file_safe = is_link_safe = False
+
+        safe_list.append(is_link_safe)
 
     return is_file_safe, is_photo_safe, safe_list
@@ -0,0 +1,110 @@
+import hashlib
+import threading
+
+from collections import Counter
+from datetime import datetime, timedelta
+
+from group_defender.cache import TTLCache
+from group_defender.constants import (
+    VERDICT_CACHE_SIZE,
+    VERDICT_CACHE_TTL,
+    VERDICT_LIFETIME,
+)
+from group_defender.storage import storage
+
+MEMORY_HITS = "memory_hits"
+STORAGE_HITS = "storage_hits"
+SCANS = "scans"
+
+verdict_cache = TTLCache(VERDICT_CACHE_SIZE, VERDICT_CACHE_TTL)
+verdict_counts = Counter()
+counts_lock = threading.Lock()
+
+
+def uid_key(file_unique_id):
+    return f"uid:{file_unique_id}"
+
+
+def digest_key(media):
+    """
+    Get the verdict key of a file from the SHA-256 digest of its content
+    Args:
+        media: the file object
+
+    Returns:
+        The string of the verdict key
+    """
+    sha = hashlib.sha256()
+    media.seek(0)
+
+    for chunk in iter(lambda: media.read(65536), b""):
+        sha.update(chunk)
+
+    return f"sha256:{sha.hexdigest()}"
+
+
+def get_verdict(key):
+    """
+    Get the cached verdict of a file, checking memory first and then the storage
+    Args:
+        key: the string of the verdict key
+
+    Returns:
+        A tuple of a bool indicating if the file is safe or not and the likelihood,
+        or None if there is no cached verdict
+    """
+    verdict = verdict_cache.get(key)
+    if verdict is not None:
+        count_verdict(MEMORY_HITS)
+
+        return verdict
+
+    verdict = storage.get_verdict(key)
+    if verdict is not None:
+        verdict_cache.set(key, verdict)
+        count_verdict(STORAGE_HITS)
+
+        return verdict
+
+    return None
+
+
+def store_verdict(keys, is_safe, likelihood, scanned=False):
+    """
+    Store the verdict of a file in memory and in the storage
+    Args:
+        keys: the list of verdict keys of the file
+        is_safe: the bool indicating if the file is safe or not
+        likelihood: the string of the likelihood
+        scanned: the bool indicating if the verdict came from a new scan
+
+    Returns:
+        None
+    """
+    if scanned:
+        count_verdict(SCANS)
+
+    # Failed scans are not cached so that they can be retried
+    if is_safe is None:
+        return
+
+    for key in keys:
+        verdict_cache.set(key, (is_safe, likelihood))
+
+    expiry = datetime.utcnow() + timedelta(days=VERDICT_LIFETIME)
+    storage.put_verdicts(keys, is_safe, likelihood, expiry)
+
+
+def count_verdict(name):
+    with counts_lock:
+        verdict_counts[name] += 1
+
+
+def get_verdict_counts():
+    """
+    Get the hit and miss counts of the verdict cache since the process started
+    Returns:
+        A dict of the memory hits, storage hits and scans
+    """
+    with counts_lock:
+        return {x: verdict_counts[x] for x in (MEMORY_HITS, STORAGE_HITS, SCANS)}
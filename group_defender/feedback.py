@@ -1,20 +1,14 @@
-import os
-
-from dotenv import load_dotenv
 from logbook import Logger
-from slack import WebClient
-from textblob import TextBlob
-from textblob.exceptions import TranslatorError
 from telegram.ext import CommandHandler, ConversationHandler, MessageHandler, Filters
 from telegram.ext.dispatcher import run_async
 
-from group_defender.utils import cancel, get_setting
-
-load_dotenv()
-SLACK_TOKEN = os.environ.get("SLACK_TOKEN")
+from group_defender.lazy import lazy_import
+from group_defender.settings import get_setting
+from group_defender.utils import cancel
 
-if SLACK_TOKEN is None:
-    SLACK_TOKEN = get_setting("SLACK_TOKEN")
+slack = lazy_import("slack")
+textblob = lazy_import("textblob")
+textblob_exceptions = lazy_import("textblob.exceptions")
 
 
 # Creates a feedback conversation handler
@@ -64,11 +58,11 @@ def receive_feedback(update, _):
     tele_id = message.chat.id
     feedback_msg = message.text
     feedback_lang = None
-    b = TextBlob(feedback_msg)
+    b = textblob.TextBlob(feedback_msg)
 
     try:
         feedback_lang = b.detect_language()
-    except TranslatorError:
+    except textblob_exceptions.TranslatorError:
         pass
 
     if not feedback_lang or feedback_lang.lower() != "en":
@@ -81,8 +75,9 @@ def receive_feedback(update, _):
     )
     success = False
 
-    if SLACK_TOKEN is not None:
-        client = WebClient(token=SLACK_TOKEN)
+    slack_token = get_setting("SLACK_TOKEN")
+    if slack_token is not None:
+        client = slack.WebClient(token=slack_token)
         response = client.chat_postMessage(channel="#grp-def-feedback", text=text)
 
         if response["ok"] and response["message"]["text"] == text:
@@ -0,0 +1,76 @@
+import importlib
+import threading
+
+from logbook import Logger
+
+# The lazy modules by their names
+lazy_modules = {}
+
+
+class LazyModule:
+    """
+    A stand-in for a module that is only imported when one of its attributes is
+    first used, so that heavy dependencies of rare paths don't slow down startup
+    """
+
+    def __init__(self, name):
+        """
+        Args:
+            name: the string of the full module name
+        """
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def load(self):
+        """
+        Import the module if it has not been imported yet
+        Returns:
+            The module
+        """
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+
+        return self._module
+
+
+def lazy_import(name):
+    """
+    Get a module that is imported on first use
+    Args:
+        name: the string of the full module name
+
+    Returns:
+        The lazy module
+    """
+    if name not in lazy_modules:
+        lazy_modules[name] = LazyModule(name)
+
+    return lazy_modules[name]
+
+
+def prewarm_modules():
+    """
+    Import all the lazy modules in a background thread, so that the first messages
+    that need them don't have to wait for the imports
+
+    Returns:
+        The started thread
+    """
+
+    def load_all():
+        for name, module in list(lazy_modules.items()):
+            try:
+                module.load()
+            except ImportError as e:
+                Logger().warn(f"Failed to prewarm {name}: {e}")
+
+    thread = threading.Thread(target=load_all, daemon=True)
+    thread.start()
+
+    return thread
@@ -0,0 +1,60 @@
+from group_defender.aio import call_bot
+from group_defender.cache import TTLCache
+from group_defender.constants import MEMBER_CACHE_SIZE, MEMBER_CACHE_TTL
+
+member_cache = TTLCache(MEMBER_CACHE_SIZE, MEMBER_CACHE_TTL)
+
+
+def get_member_status(bot, chat_id, user_id):
+    """
+    Get the status of a chat member, only calling the Bot API on a cache miss
+    Args:
+        bot: the bot object
+        chat_id: the int of the chat ID
+        user_id: the int of the user ID
+
+    Returns:
+        The string of the member status
+    """
+    status = member_cache.get((chat_id, user_id))
+    if status is None:
+        status = bot.get_chat_member(chat_id, user_id).status
+        member_cache.set((chat_id, user_id), status)
+
+    return status
+
+
+async def fetch_member_status(bot, chat_id, user_id):
+    """
+    Get the status of a chat member on the core, only calling the Bot API on a
+    cache miss
+    Args:
+        bot: the bot object
+        chat_id: the int of the chat ID
+        user_id: the int of the user ID
+
+    Returns:
+        The string of the member status
+    """
+    status = member_cache.get((chat_id, user_id))
+    if status is None:
+        member = await call_bot(bot, "getChatMember", chat_id=chat_id, user_id=user_id)
+        status = member["status"]
+        member_cache.set((chat_id, user_id), status)
+
+    return status
+
+
+def update_member_status(update, _):
+    """
+    Update the cached status of a chat member when it changes
+    Args:
+        update: the update object
+        _: unused variable
+
+    Returns:
+        None
+    """
+    member_update = update.my_chat_member or update.chat_member
+    member = member_update.new_chat_member
+    member_cache.set((member_update.chat.id, member.user.id), member.status)
@@ -0,0 +1,349 @@
+import bisect
+import functools
+import itertools
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from logbook import Logger
+from telegram.error import RetryAfter, TelegramError
+
+from group_defender.cache import TTLCache
+from group_defender.constants import (
+    OUTBOX_CACHE_SIZE,
+    OUTBOX_CHAT_BURST,
+    OUTBOX_CHAT_RATE,
+    OUTBOX_NOTICE_MAX,
+    OUTBOX_NOTICE_WINDOW,
+    OUTBOX_RATE,
+    OUTBOX_WORKERS,
+)
+
+# Priorities of the actions, lower ones go first
+DELETION = 0
+RESTORE = 1
+NOTICE = 2
+
+
+class TokenBucket:
+    """
+    A rate limit that allows short bursts, only used under the lock of the outbox
+    """
+
+    def __init__(self, rate, burst):
+        """
+        Args:
+            rate: the number of tokens added per second
+            burst: the int of the maximum number of tokens
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        """
+        Args:
+            now: the float of the monotonic time
+
+        Returns:
+            The float of the seconds until a token is available
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self.tokens -= 1
+
+
+class Action:
+    def __init__(self, priority, chat_id, func, limited, callback, not_before=0):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.func = func
+        self.limited = limited
+        self.callback = callback
+        self.not_before = not_before
+
+
+class Outbox:
+    """
+    A queue of the Bot API calls of deletions, restores and notices that keeps to
+    Telegram's flood limits
+
+    Calls are made in order of priority, so deletions go ahead of restores and
+    notices, while keeping to a global rate and a rate per chat for the messages
+    sent. A chat that is told to retry after a while by the flood control is paused
+    for that long instead of losing its calls, and the notices of a chat sent
+    within a short window are gathered into one message.
+    """
+
+    def __init__(self, rate, chat_rate, chat_burst, notice_window, notice_max, workers):
+        """
+        Args:
+            rate: the number of calls per second across all chats
+            chat_rate: the number of messages per second sent to a chat
+            chat_burst: the int of the number of messages sent to a chat at once
+                before being spaced out
+            notice_window: the number of seconds to gather the notices of a chat
+            notice_max: the int of the maximum number of notices in one message
+            workers: the int of the number of calls in flight at the same time
+        """
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.notice_window = notice_window
+        self.notice_max = notice_max
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="outbox"
+        )
+        self.retries = 0
+
+        # An idle chat's bucket has refilled by the time it expires
+        self._buckets = TTLCache(OUTBOX_CACHE_SIZE, chat_burst / chat_rate)
+        self._bucket = TokenBucket(rate, rate)
+        self._pending = []  # Tuples of priority, arrival and action, in order
+        self._paused = {}  # Chat IDs to the times that their flood control ends
+        self._notices = {}  # Chat IDs and send functions to the gathered notices
+        self._arrivals = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(
+        self, priority, chat_id, func, *args, limited=True, callback=None, **kwargs
+    ):
+        """
+        Queue a Bot API call
+        Args:
+            priority: the int of the priority of the call
+            chat_id: the int of the chat ID that the call is made in
+            func: the function of the call
+            *args: the positional arguments of the function
+            limited: the bool indicating if the call sends a message and counts
+                towards the rate of the chat
+            callback: the function called with the result and the error of the
+                call, errors are logged if it is None
+            **kwargs: the keyword arguments of the function
+
+        Returns:
+            None
+        """
+        self._add(
+            Action(
+                priority,
+                chat_id,
+                functools.partial(func, *args, **kwargs),
+                limited,
+                callback,
+            )
+        )
+
+    def delete_message(self, bot, chat_id, message_id, callback=None):
+        """
+        Queue the deletion of a message ahead of any messages to be sent
+        Args:
+            bot: the bot object
+            chat_id: the int of the chat ID
+            message_id: the int of the message ID
+            callback: the function called with the result and the error of the call
+
+        Returns:
+            None
+        """
+        self.submit(
+            DELETION,
+            chat_id,
+            bot.delete_message,
+            chat_id,
+            message_id,
+            limited=False,
+            callback=callback,
+        )
+
+    def send_notice(self, bot, chat_id, notice, send):
+        """
+        Queue a notice to be gathered with the other notices of the chat sent within
+        the notice window, and sent in one message
+        Args:
+            bot: the bot object
+            chat_id: the int of the chat ID
+            notice: the notice to pass to the send function
+            send: the function that takes the bot, the chat ID and a list of
+                notices and sends them in one message
+
+        Returns:
+            None
+        """
+        key = (chat_id, send)
+        with self._cond:
+            notices = self._notices.setdefault(key, [])
+            notices.append(notice)
+
+            if len(notices) > 1:
+                return
+
+        self._add(
+            Action(
+                NOTICE,
+                chat_id,
+                functools.partial(self._send_notices, bot, key),
+                True,
+                None,
+                time.monotonic() + self.notice_window,
+            )
+        )
+
+    def get_stats(self):
+        """
+        Returns:
+            A dict of the calls waiting, the chats under flood control, and the
+            calls retried after being limited by the flood control
+        """
+        with self._cond:
+            now = time.monotonic()
+
+            return {
+                "pending": len(self._pending),
+                "paused": sum(x > now for x in self._paused.values()),
+                "retries": self.retries,
+            }
+
+    def _add(self, action):
+        with self._cond:
+            bisect.insort(
+                self._pending, (action.priority, next(self._arrivals), action)
+            )
+            self._cond.notify()
+
+    def _send_notices(self, bot, key):
+        with self._cond:
+            notices = self._notices.pop(key, None)
+            if not notices:
+                return
+
+            # Send the rest in the next message
+            if len(notices) > self.notice_max:
+                self._notices[key] = notices[self.notice_max :]
+                notices = notices[: self.notice_max]
+                self._add(
+                    Action(
+                        NOTICE,
+                        key[0],
+                        functools.partial(self._send_notices, bot, key),
+                        True,
+                        None,
+                    )
+                )
+
+        chat_id, send = key
+        try:
+            send(bot, chat_id, notices)
+        except RetryAfter:
+            # Put them back to be sent when the call is retried, along with any
+            # notices gathered in the meantime
+            with self._cond:
+                self._notices[key] = notices + self._notices.get(key, [])
+
+            raise
+
+    def _next(self):
+        """
+        Get the first call by priority that can be made now
+        Returns:
+            A tuple of the action or None, and the float of the seconds until a call
+            may be ready, None if there are no calls
+        """
+        now = time.monotonic()
+        delay = self._bucket.delay(now)
+
+        if not self._pending:
+            return None, None
+        elif delay > 0:
+            return None, delay
+
+        delay = None
+        for i, (_, _, action) in enumerate(self._pending):
+            wait = max(action.not_before, self._paused.get(action.chat_id, 0)) - now
+            bucket = None
+
+            if action.limited:
+                bucket = self._buckets.get(action.chat_id)
+                if bucket is None:
+                    bucket = TokenBucket(self.chat_rate, self.chat_burst)
+
+                wait = max(wait, bucket.delay(now))
+
+            if wait <= 0:
+                del self._pending[i]
+                self._bucket.take()
+
+                if bucket is not None:
+                    bucket.take()
+                    self._buckets.set(action.chat_id, bucket)
+
+                return action, None
+
+            delay = wait if delay is None else min(delay, wait)
+
+        return None, delay
+
+    def _run(self):
+        while True:
+            with self._cond:
+                action, delay = self._next()
+                while action is None:
+                    self._cond.wait(delay)
+                    action, delay = self._next()
+
+                if self._paused:
+                    now = time.monotonic()
+                    self._paused = {k: v for k, v in self._paused.items() if v > now}
+
+            self.executor.submit(self._call, action)
+
+    def _call(self, action):
+        # Exceptions raised on the executor are kept in futures that nothing reads
+        try:
+            self._make_call(action)
+        except Exception:
+            Logger().exception(f"Failed to process a call in chat {action.chat_id}")
+
+    def _make_call(self, action):
+        result = error = None
+        try:
+            result = action.func()
+        except RetryAfter as e:
+            with self._cond:
+                resume = time.monotonic() + e.retry_after
+                self._paused[action.chat_id] = max(
+                    resume, self._paused.get(action.chat_id, 0)
+                )
+                self.retries += 1
+
+            Logger().warn(
+                f"Flood control in chat {action.chat_id}, retrying in {e.retry_after}s"
+            )
+            self._add(action)
+
+            return
+        except TelegramError as e:
+            error = e
+
+        if action.callback is not None:
+            action.callback(result, error)
+        elif error is not None:
+            Logger().error(
+                f"Failed to call the Bot API in chat {action.chat_id}: {error}"
+            )
+
+
+outbox = Outbox(
+    OUTBOX_RATE,
+    OUTBOX_CHAT_RATE,
+    OUTBOX_CHAT_BURST,
+    OUTBOX_NOTICE_WINDOW,
+    OUTBOX_NOTICE_MAX,
+    OUTBOX_WORKERS,
+)
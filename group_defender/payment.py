@@ -1,7 +1,5 @@
-import os
 import re
 
-from dotenv import load_dotenv
 from telegram import LabeledPrice, ReplyKeyboardMarkup, ReplyKeyboardRemove, Chat
 from telegram.ext import ConversationHandler, MessageHandler, CommandHandler, Filters
 from telegram.ext.dispatcher import run_async
@@ -18,15 +16,11 @@ from group_defender.constants import (
     PAYMENT_CURRENCY,
     WAIT_PAYMENT,
 )
-from group_defender.utils import cancel, get_setting
+from group_defender.settings import get_setting
+from group_defender.utils import cancel
 
-load_dotenv()
-STRIPE_TOKEN = os.environ.get("STRIPE_TOKEN", os.environ.get("STRIPE_TOKEN_BETA"))
 BOT_NAME = "Group Defender"
 
-if STRIPE_TOKEN is None:
-    STRIPE_TOKEN = get_setting("STRIPE_TOKEN")
-
 
 def payment_cov_handler():
     """
@@ -120,7 +114,7 @@ def send_payment_invoice(update, context, amount=None):
         title,
         description,
         PAYMENT_PAYLOAD,
-        STRIPE_TOKEN,
+        get_setting("STRIPE_TOKEN"),
         PAYMENT_PARA,
         PAYMENT_CURRENCY,
         prices,
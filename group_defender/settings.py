@@ -0,0 +1,85 @@
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from group_defender.storage import storage
+
+load_dotenv()
+
+# The settings that the bot needs and the environment variables that override them,
+# checked in order
+SETTINGS = {
+    "TELE_TOKEN": ("TELE_TOKEN_BETA", "TELE_TOKEN"),
+    "DEV_TELE_ID": ("DEV_TELE_ID",),
+    "GOOGLE_TOKEN": ("GOOGLE_TOKEN",),
+    "AZURE_TOKEN": ("AZURE_TOKEN",),
+    "AZURE_LOC": ("AZURE_LOC",),
+    "SCANNER_TOKEN": ("SCANNER_TOKEN",),
+    "SLACK_TOKEN": ("SLACK_TOKEN",),
+    "STRIPE_TOKEN": ("STRIPE_TOKEN", "STRIPE_TOKEN_BETA"),
+}
+
+stored_settings = {}
+load_time = None
+load_lock = threading.Lock()
+
+
+def get_setting(name):
+    """
+    Get a setting from the environment variables, or else from the storage. All the
+    stored settings are loaded together on the first lookup.
+    Args:
+        name: the string of the setting name
+
+    Returns:
+        The setting value, or None if it is not set
+    """
+    for env_name in SETTINGS.get(name, (name,)):
+        value = os.environ.get(env_name)
+        if value is not None:
+            return value
+
+    if load_time is None:
+        with load_lock:
+            if load_time is None:
+                load_settings()
+
+    return stored_settings.get(name)
+
+
+def get_settings(names):
+    return [get_setting(x) for x in names]
+
+
+def load_settings():
+    """
+    Fetch all the settings that are not set as environment variables in one call
+
+    Returns:
+        None
+    """
+    global stored_settings, load_time
+    names = [
+        name
+        for name, env_names in SETTINGS.items()
+        if all(os.environ.get(x) is None for x in env_names)
+    ]
+    values = storage.get_settings(names) if names else []
+
+    stored_settings = dict(zip(names, values))
+    load_time = time.monotonic()
+
+
+def refresh_settings(_):
+    """
+    Reload the stored settings so that changes are picked up without a restart
+    Args:
+        _: unused variable
+
+    Returns:
+        None
+    """
+    with load_lock:
+        load_settings()
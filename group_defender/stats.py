@@ -1,68 +1,332 @@
-import matplotlib
+import os
+import tempfile
+import threading
 
-matplotlib.use("Agg")
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from logbook import Logger
 
-import matplotlib.pyplot as plt
-import tempfile
+from group_defender.constants import (
+    BLOCKED,
+    DAY,
+    FILE_TYPES,
+    HOUR,
+    MONTH,
+    NUM_GROUPS,
+    NUM_USERS,
+    STATS_BATCH_SIZE,
+    STATS_DAY_RETENTION,
+    STATS_FLUSH_SIZE,
+    STATS_HOUR_RETENTION,
+)
+from group_defender.batch import get_collapsed_counts
+from group_defender.core import core
+from group_defender.defend.classifier import get_tier_counts
+from group_defender.defend.verdict import get_verdict_counts
+from group_defender.lazy import lazy_import
+from group_defender.outbox import outbox
+from group_defender.storage import storage
+
+# Render the charts without a display, which has to be set before pyplot is imported
+os.environ["MPLBACKEND"] = "Agg"
+plt = lazy_import("matplotlib.pyplot")
+
+
+# Buckets of each resolution are written together, finer ones expire once they are
+# older than their retention and the coarser ones are left
+BUCKET_RETENTION = {
+    HOUR: timedelta(days=STATS_HOUR_RETENTION),
+    DAY: timedelta(days=STATS_DAY_RETENTION),
+    MONTH: None,
+}
+CHART_POINTS = {HOUR: 48, DAY: 30, MONTH: 12}
+
+pending_stats = defaultdict(Counter)
+pending_buckets = defaultdict(Counter)
+pending_lock = threading.Lock()
+
+# Set by the handlers once enough chats are pending, so that the early write runs
+# on the flusher thread rather than in a handler
+flush_requested = threading.Event()
+
+
+def update_stats(chat_id, counts, blocked=None):
+    """
+    Add the counts to the chat's stats and to the current hour of the stats history,
+    which are written to the storage in batches
+    Args:
+        chat_id: the int of the chat ID
+        counts: the dict of file types to counts
+        blocked: the dict of file types to counts that were found unsafe
+
+    Returns:
+        None
+    """
+    hour = bucket_start(HOUR, datetime.utcnow())
+    with pending_lock:
+        pending_stats[chat_id].update(counts)
+        pending_buckets[hour].update(counts)
+
+        if blocked:
+            pending_buckets[hour].update(
+                {blocked_name(k): v for k, v in blocked.items()}
+            )
+
+        num_chats = len(pending_stats)
+
+    if num_chats >= STATS_FLUSH_SIZE:
+        flush_requested.set()
+
+
+def run_flusher():
+    while True:
+        flush_requested.wait()
+        flush_requested.clear()
+
+        try:
+            flush_stats()
+        except Exception:
+            Logger().exception("Failed to write the pending stats early")
+
+
+threading.Thread(target=run_flusher, daemon=True).start()
+
+
+def flush_stats(_=None):
+    """
+    Write the pending stats to the storage, merging them into the chats' stats
+    Args:
+        _: unused variable
+
+    Returns:
+        None
+    """
+    global pending_stats, pending_buckets
+    with pending_lock:
+        stats, pending_stats = pending_stats, defaultdict(Counter)
+        buckets, pending_buckets = pending_buckets, defaultdict(Counter)
+
+    try:
+        write_buckets(buckets)
+    except Exception:
+        with pending_lock:
+            for hour, counts in buckets.items():
+                pending_buckets[hour].update(counts)
+
+            for chat_id, counts in stats.items():
+                pending_stats[chat_id].update(counts)
+
+        raise
+
+    chat_ids = list(stats)
+    for i in range(0, len(chat_ids), STATS_BATCH_SIZE):
+        batch_ids = chat_ids[i : i + STATS_BATCH_SIZE]
+        try:
+            write_stats({x: stats[x] for x in batch_ids})
+        except Exception:
+            # Put the unwritten stats back so that they are written next time
+            with pending_lock:
+                for chat_id in chat_ids[i:]:
+                    pending_stats[chat_id].update(stats[chat_id])
+
+            raise
+
+
+def write_stats(stats):
+    """
+    Add the counts to the chats' stats and to the global rollup in one transaction
+    Args:
+        stats: the dict of chat IDs to counters of file types
 
-from collections import defaultdict
-from google.cloud import datastore
+    Returns:
+        None
+    """
+    storage.add_chat_stats(stats)
 
-from group_defender.constants import CHAT, FILE_TYPES
-from group_defender.store import datastore_client as client
 
+def write_buckets(buckets):
+    """
+    Add the hourly counts to their hour, day and month buckets in one transaction
+    Args:
+        buckets: the dict of hour start times to counters of file types
 
-def update_stats(chat_id, counts):
-    key = client.key(CHAT, chat_id)
-    with client.transaction():
-        chat = client.get(key)
-        if chat is None:
-            chat = datastore.Entity(key)
+    Returns:
+        None
+    """
+    totals = defaultdict(Counter)
+    for hour, counts in buckets.items():
+        for resolution in BUCKET_RETENTION:
+            totals[(resolution, bucket_start(resolution, hour))].update(counts)
 
-        for file_type in counts:
-            if file_type in chat:
-                chat[file_type] += counts[file_type]
-            else:
-                chat[file_type] = 1
+    if totals:
+        storage.add_stats_buckets(
+            [
+                (resolution, start, bucket_expiry(resolution, start), counts)
+                for (resolution, start), counts in totals.items()
+            ]
+        )
 
-        client.put(chat)
 
+def bucket_start(resolution, time):
+    time = time.replace(minute=0, second=0, microsecond=0)
+    if resolution != HOUR:
+        time = time.replace(hour=0)
 
-def get_stats(update, _):
-    query = client.query(kind=CHAT)
-    counts = defaultdict(int)
-    total = 0
+    if resolution == MONTH:
+        time = time.replace(day=1)
 
-    for chat in query.fetch():
-        if chat.key.id > 0:
-            counts["num_users"] += 1
+    return time
+
+
+def bucket_expiry(resolution, start):
+    retention = BUCKET_RETENTION[resolution]
+
+    return None if retention is None else start + retention
+
+
+def blocked_name(file_type):
+    return f"{file_type}_{BLOCKED}"
+
+
+def get_buckets(resolution, num_buckets):
+    """
+    Get the most recent stats buckets of the resolution
+    Args:
+        resolution: the string of the bucket resolution
+        num_buckets: the int of the number of buckets
+
+    Returns:
+        A list of tuples of the start time and the dict of counts of each bucket,
+        oldest first
+    """
+    starts = [bucket_start(resolution, datetime.utcnow())]
+    for _ in range(num_buckets - 1):
+        if resolution == HOUR:
+            start = starts[-1] - timedelta(hours=1)
         else:
-            counts["num_groups"] += 1
+            start = bucket_start(resolution, starts[-1] - timedelta(days=1))
+
+        starts.append(start)
+
+    starts.reverse()
+
+    return list(zip(starts, storage.get_stats_buckets(resolution, starts)))
+
+
+def rebuild_global_stats():
+    """
+    Recompute the global rollup from the stats of all the chats. Stats written while
+    this runs may be lost, so it should be run while the bot is stopped.
+
+    Returns:
+        The dict of the global counts
+    """
+    return storage.rebuild_global_stats()
 
-        for file_type in FILE_TYPES:
-            if file_type in chat:
-                counts[file_type] += chat[file_type]
-                total += chat[file_type]
 
+def get_stats(update, context):
+    if context.args:
+        send_history(update, context.args)
+
+        return
+
+    counts = defaultdict(int, storage.get_global_stats())
+    total = sum(counts[x] for x in FILE_TYPES)
+
+    verdict_counts = get_verdict_counts()
+    tier_counts = get_tier_counts()
+    lane_stats = "\n".join(
+        f'{name}: {x["waiting"]} waiting, {x["running"]} running, '
+        f'{x["mean_wait"] * 1000:.0f} ms mean wait, {x["max_wait"] * 1000:.0f} ms max, '
+        f'{x["overloaded"]} chats on cheap checks ({x["cheap"]} updates)'
+        for name, x in core.get_lane_stats().items()
+    )
+    outbox_stats = outbox.get_stats()
+    collapsed = ", ".join(f"{v} {k}" for k, v in get_collapsed_counts().items())
     update.effective_message.reply_text(
-        f'Number of users: {counts["num_users"]}\nNumber of groups: {counts["num_groups"]}\n'
-        f"Total processed: {total}"
+        f"Number of users: {counts[NUM_USERS]}\nNumber of groups: {counts[NUM_GROUPS]}\n"
+        f"Total processed: {total}\n\n"
+        f'Verdict cache hits: {verdict_counts["memory_hits"]} (memory), '
+        f'{verdict_counts["storage_hits"]} (storage)\n'
+        f'Verdict cache misses: {verdict_counts["scans"]}\n'
+        f'Local classifier: {tier_counts["local_safe"]} safe, '
+        f'{tier_counts["local_unsafe"]} unsafe, {tier_counts["escalated"]} escalated\n'
+        f"Duplicate checks collapsed: {collapsed}\n\n"
+        f"Processing lanes:\n{lane_stats}\n\n"
+        f'Outbound queue: {outbox_stats["pending"]} waiting, '
+        f'{outbox_stats["paused"]} chats under flood control, '
+        f'{outbox_stats["retries"]} retries'
     )
     send_plot(update, counts)
 
 
-def send_plot(update, counts):
-    nums = [counts[x] for x in FILE_TYPES]
-    x_pos = list(range(len(FILE_TYPES)))
+def send_history(update, args):
+    """
+    Send a chart of the processed and blocked counts over time
+    Args:
+        update: the update object
+        args: the list of the resolution and optionally a file type
+
+    Returns:
+        None
+    """
+    resolution = args[0].lower()
+    file_type = args[1].lower() if len(args) > 1 else None
+
+    if resolution not in CHART_POINTS or (
+        file_type is not None and file_type not in FILE_TYPES
+    ):
+        update.effective_message.reply_text(
+            f'Usage: /stats [{"|".join(CHART_POINTS)}] [{"|".join(FILE_TYPES)}]'
+        )
+
+        return
 
+    file_types = FILE_TYPES if file_type is None else [file_type]
+    buckets = get_buckets(resolution, CHART_POINTS[resolution])
+    starts = [x for x, _ in buckets]
+    series = {
+        "Processed": [sum(x.get(y, 0) for y in file_types) for _, x in buckets],
+        "Blocked": [
+            sum(x.get(blocked_name(y), 0) for y in file_types) for _, x in buckets
+        ],
+    }
+    send_plot(update, starts, series, f"Counts per {resolution}")
+
+
+def send_plot(update, counts, series=None, y_label="Counts"):
+    """
+    Send a bar chart of the counts of each file type, or a line chart of the series
+    over time
+    Args:
+        update: the update object
+        counts: the dict of file types to counts, or the list of times of the series
+        series: the dict of line labels to lists of counts
+        y_label: the string of the y-axis label
+
+    Returns:
+        None
+    """
     plt.rcdefaults()
-    _, ax = plt.subplots()
+    fig, ax = plt.subplots()
+
+    if series is None:
+        nums = [counts[x] for x in FILE_TYPES]
+        x_pos = list(range(len(FILE_TYPES)))
+
+        ax.bar(x_pos, nums, align="center")
+        ax.set_xticks(x_pos)
+        ax.set_xticklabels(FILE_TYPES, rotation=45)
+        ax.set_xlabel("File Types")
+    else:
+        for label, nums in series.items():
+            ax.plot(counts, nums, label=label)
+
+        ax.legend()
+        fig.autofmt_xdate()
+        ax.set_xlabel("Time (UTC)")
 
-    ax.bar(x_pos, nums, align="center")
-    ax.set_xticks(x_pos)
-    ax.set_xticklabels(FILE_TYPES, rotation=45)
-    ax.set_xlabel("File Types")
-    ax.set_ylabel("Counts")
+    ax.set_ylabel(y_label)
     plt.tight_layout()
 
     with tempfile.NamedTemporaryFile(suffix=".png") as tf:
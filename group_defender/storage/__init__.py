@@ -0,0 +1,18 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "datastore")
+SQLITE_DB = os.environ.get("SQLITE_DB", "group_defender.db")
+
+if STORAGE_BACKEND == "sqlite":
+    from group_defender.storage.sqlite import SQLiteStorage
+
+    storage = SQLiteStorage(SQLITE_DB)
+elif STORAGE_BACKEND == "datastore":
+    from group_defender.storage.datastore import DatastoreStorage
+
+    storage = DatastoreStorage()
+else:
+    raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
@@ -0,0 +1,167 @@
+class Storage:
+    """
+    The interface of the storage backends, covering the messages kept for undo, the
+    chat stats and history, the settings, the API counters, the cached verdicts and
+    the hashes of unsafe images
+    """
+
+    def put_message(self, chat_id, msg_id, msg):
+        """
+        Store a deleted message so that it can be restored
+        Args:
+            chat_id: the int of the chat ID
+            msg_id: the int of the message ID
+            msg: the dict of the message fields, including its expiry
+        """
+        raise NotImplementedError
+
+    def pop_message(self, chat_id, msg_id):
+        """
+        Get and delete a stored message
+        Args:
+            chat_id: the int of the chat ID
+            msg_id: the int of the message ID
+
+        Returns:
+            The dict of the message fields, or None if there is no such message
+        """
+        raise NotImplementedError
+
+    def delete_expired(self, deadline):
+        """
+        Delete the expired messages, verdicts and stats buckets, stopping at the
+        deadline and resuming from there on the next call
+        Args:
+            deadline: the monotonic time to stop at
+
+        Returns:
+            A tuple of the int of the number of deleted entries and a bool
+            indicating if there are more left
+        """
+        raise NotImplementedError
+
+    def add_chat_stats(self, stats):
+        """
+        Add the counts to the chats' stats and to the global rollup in one
+        transaction, counting the chats that are new
+        Args:
+            stats: the dict of chat IDs to counters of file types
+        """
+        raise NotImplementedError
+
+    def get_global_stats(self):
+        """
+        Returns:
+            A dict of the global counts of the file types, users and groups
+        """
+        raise NotImplementedError
+
+    def rebuild_global_stats(self):
+        """
+        Recompute the global rollup from the stats of all the chats
+
+        Returns:
+            A dict of the global counts
+        """
+        raise NotImplementedError
+
+    def add_stats_buckets(self, buckets):
+        """
+        Add the counts to the stats history buckets in one transaction
+        Args:
+            buckets: the list of tuples of the resolution, start time, expiry time
+                (None to keep the bucket forever) and counter of each bucket
+        """
+        raise NotImplementedError
+
+    def get_stats_buckets(self, resolution, starts):
+        """
+        Args:
+            resolution: the string of the bucket resolution
+            starts: the list of start times of the buckets
+
+        Returns:
+            A list of the dicts of counts of the buckets, empty for missing buckets
+        """
+        raise NotImplementedError
+
+    def get_settings(self, names):
+        """
+        Args:
+            names: the list of setting names
+
+        Returns:
+            A list of the setting values, None for missing settings
+        """
+        raise NotImplementedError
+
+    def update_api_count(self, name, year, month, delta, limit):
+        """
+        Lease or give back calls on the monthly counter of a provider
+        Args:
+            name: the string of the provider name
+            year: the int of the year
+            month: the int of the month
+            delta: the int of the number of calls, negative to give them back
+            limit: the int of the monthly number of calls
+
+        Returns:
+            The int of the number of calls that were actually leased
+        """
+        raise NotImplementedError
+
+    def get_verdict(self, key):
+        """
+        Args:
+            key: the string of the verdict key
+
+        Returns:
+            A tuple of the bool indicating if the file is safe or not and the
+            likelihood, or None if there is no verdict or it has expired
+        """
+        raise NotImplementedError
+
+    def put_verdicts(self, keys, is_safe, likelihood, expiry):
+        """
+        Args:
+            keys: the list of verdict keys of the file
+            is_safe: the bool indicating if the file is safe or not
+            likelihood: the string of the likelihood
+            expiry: the datetime of the expiry
+        """
+        raise NotImplementedError
+
+    def add_phash(self, image_hash, created):
+        """
+        Args:
+            image_hash: the int hash of an unsafe image
+            created: the datetime when the image was flagged
+        """
+        raise NotImplementedError
+
+    def get_phashes(self, since=None):
+        """
+        Args:
+            since: the datetime to get the hashes flagged since, None to get all
+
+        Returns:
+            A list of the int hashes
+        """
+        raise NotImplementedError
+
+
+def clamp_delta(count, delta, limit):
+    """
+    Limit a lease to the calls left under the limit, and a give back to the count
+    Args:
+        count: the int of the current count
+        delta: the int of the number of calls, negative to give them back
+        limit: the int of the limit
+
+    Returns:
+        The int of the clamped delta
+    """
+    if delta > 0:
+        return max(min(delta, limit - count), 0)
+
+    return max(delta, -count)
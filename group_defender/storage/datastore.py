@@ -0,0 +1,280 @@
+import random
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from google.cloud import datastore
+
+from group_defender.constants import (
+    API_COUNT,
+    CHAT,
+    COUNT,
+    CREATED,
+    EXPIRY,
+    FILE_TYPES,
+    GLOBAL_STATS,
+    IS_SAFE,
+    LIKELIHOOD,
+    MONTH,
+    MSG,
+    NAME,
+    NUM_GROUPS,
+    NUM_USERS,
+    PHASH,
+    RESOLUTION,
+    SETTING,
+    START,
+    STATS_BUCKET,
+    STATS_SHARDS,
+    SWEEP_BATCH_SIZE,
+    SWEEP_WORKERS,
+    VALUE,
+    VERDICT,
+    YEAR,
+)
+from group_defender.storage.base import Storage, clamp_delta
+
+
+class DatastoreStorage(Storage):
+    """
+    The storage backend on Google Cloud Datastore
+    """
+
+    def __init__(self):
+        self.client = datastore.Client()
+
+        # The cutoff time and cursor of each kind where the last sweep stopped
+        self.sweep_state = {}
+
+    def put_message(self, chat_id, msg_id, msg):
+        entity = datastore.Entity(self.client.key(MSG, f"{chat_id},{msg_id}"))
+        entity.update(msg)
+        self.client.put(entity)
+
+    def pop_message(self, chat_id, msg_id):
+        key = self.client.key(MSG, f"{chat_id},{msg_id}")
+        entity = self.client.get(key)
+
+        if entity is None:
+            return None
+
+        self.client.delete(key)
+
+        return dict(entity)
+
+    def delete_expired(self, deadline):
+        num_deleted = 0
+        with ThreadPoolExecutor(SWEEP_WORKERS) as executor:
+            for kind in (MSG, VERDICT, STATS_BUCKET):
+                num_deleted += self.sweep_kind(kind, executor, deadline)
+
+        return num_deleted, bool(self.sweep_state)
+
+    def sweep_kind(self, kind, executor, deadline):
+        """
+        Page through the expired keys of the kind and delete them in chunks
+        Args:
+            kind: the string of the entity kind
+            executor: the executor to run the delete calls on
+            deadline: the monotonic time to stop paging at
+
+        Returns:
+            The int of the number of deleted entities
+        """
+        cutoff, cursor = self.sweep_state.pop(kind, (datetime.utcnow(), None))
+        query = self.client.query(kind=kind)
+        query.add_filter(EXPIRY, "<", cutoff)
+        query.keys_only()
+
+        futures = {}
+        num_deleted = 0
+
+        while True:
+            if time.monotonic() >= deadline:
+                self.sweep_state[kind] = (cutoff, cursor)
+                break
+
+            query_iter = query.fetch(start_cursor=cursor, limit=SWEEP_BATCH_SIZE)
+            keys = [x.key for x in next(query_iter.pages)]
+            cursor = query_iter.next_page_token
+
+            if keys:
+                futures[executor.submit(self.client.delete_multi, keys)] = len(keys)
+
+            if len(keys) < SWEEP_BATCH_SIZE or cursor is None:
+                break
+
+            # Keep at most SWEEP_WORKERS chunks of keys in memory
+            if len(futures) >= SWEEP_WORKERS:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                num_deleted += collect_deletes(futures, done)
+
+        return num_deleted + collect_deletes(futures, list(futures))
+
+    def add_chat_stats(self, stats):
+        # The chats are added to a random shard of the global rollup to spread out
+        # the write contention
+        keys = [self.client.key(CHAT, x) for x in stats]
+        shard_key = self.client.key(
+            GLOBAL_STATS, f"shard{random.randrange(STATS_SHARDS)}"
+        )
+
+        with self.client.transaction():
+            entities = self.client.get_multi(keys + [shard_key])
+            chats = {x.key.id: x for x in entities if x.key.kind == CHAT}
+            shard = next((x for x in entities if x.key.kind == GLOBAL_STATS), None)
+
+            if shard is None:
+                shard = datastore.Entity(shard_key)
+
+            entities = [shard]
+            for key in keys:
+                chat = chats.get(key.id)
+                if chat is None:
+                    chat = datastore.Entity(key)
+                    chat_count = NUM_USERS if key.id > 0 else NUM_GROUPS
+                    shard[chat_count] = shard.get(chat_count, 0) + 1
+
+                for file_type, count in stats[key.id].items():
+                    chat[file_type] = chat.get(file_type, 0) + count
+                    shard[file_type] = shard.get(file_type, 0) + count
+
+                entities.append(chat)
+
+            self.client.put_multi(entities)
+
+    def get_global_stats(self):
+        keys = [self.client.key(GLOBAL_STATS, f"shard{i}") for i in range(STATS_SHARDS)]
+        counts = {}
+
+        for shard in self.client.get_multi(keys):
+            for name, count in shard.items():
+                counts[name] = counts.get(name, 0) + count
+
+        return counts
+
+    def rebuild_global_stats(self):
+        counts = {NUM_USERS: 0, NUM_GROUPS: 0}
+        for chat in self.client.query(kind=CHAT).fetch():
+            if chat.key.id > 0:
+                counts[NUM_USERS] += 1
+            else:
+                counts[NUM_GROUPS] += 1
+
+            for file_type in FILE_TYPES:
+                counts[file_type] = counts.get(file_type, 0) + chat.get(file_type, 0)
+
+        shards = []
+        for i in range(STATS_SHARDS):
+            shard = datastore.Entity(self.client.key(GLOBAL_STATS, f"shard{i}"))
+            if i == 0:
+                shard.update(counts)
+
+            shards.append(shard)
+
+        self.client.put_multi(shards)
+
+        return counts
+
+    def add_stats_buckets(self, buckets):
+        keys = [self.client.key(STATS_BUCKET, bucket_name(*x[:2])) for x in buckets]
+        with self.client.transaction():
+            existing = {x.key.name: x for x in self.client.get_multi(keys)}
+            entities = []
+
+            for key, (resolution, start, expiry, counts) in zip(keys, buckets):
+                entity = existing.get(key.name)
+                if entity is None:
+                    entity = datastore.Entity(key)
+                    entity.update({RESOLUTION: resolution, START: start})
+
+                    if expiry is not None:
+                        entity[EXPIRY] = expiry
+
+                for name, count in counts.items():
+                    entity[name] = entity.get(name, 0) + count
+
+                entities.append(entity)
+
+            self.client.put_multi(entities)
+
+    def get_stats_buckets(self, resolution, starts):
+        names = [bucket_name(resolution, x) for x in starts]
+        keys = [self.client.key(STATS_BUCKET, x) for x in names]
+        buckets = {x.key.name: x for x in self.client.get_multi(keys)}
+
+        return [dict(buckets.get(x, {})) for x in names]
+
+    def get_settings(self, names):
+        keys = [self.client.key(SETTING, x) for x in names]
+        settings = {x.key.name: x[VALUE] for x in self.client.get_multi(keys)}
+
+        return [settings.get(x) for x in names]
+
+    def update_api_count(self, name, year, month, delta, limit):
+        with self.client.transaction():
+            key = self.client.key(API_COUNT, f"{name}{year}{month}")
+            entity = self.client.get(key)
+
+            if entity is None:
+                entity = datastore.Entity(key)
+                count = 0
+            else:
+                count = entity[COUNT]
+
+            delta = clamp_delta(count, delta, limit)
+            entity.update({NAME: name, COUNT: count + delta, YEAR: year, MONTH: month})
+            self.client.put(entity)
+
+        return delta
+
+    def get_verdict(self, key):
+        entity = self.client.get(self.client.key(VERDICT, key))
+        if entity is None or entity[EXPIRY].replace(tzinfo=None) <= datetime.utcnow():
+            return None
+
+        return entity[IS_SAFE], entity[LIKELIHOOD]
+
+    def put_verdicts(self, keys, is_safe, likelihood, expiry):
+        entities = []
+        for key in keys:
+            entity = datastore.Entity(self.client.key(VERDICT, key))
+            entity.update({IS_SAFE: is_safe, LIKELIHOOD: likelihood, EXPIRY: expiry})
+            entities.append(entity)
+
+        self.client.put_multi(entities)
+
+    def add_phash(self, image_hash, created):
+        entity = datastore.Entity(self.client.key(PHASH, f"{image_hash:016x}"))
+        entity.update({CREATED: created})
+        self.client.put(entity)
+
+    def get_phashes(self, since=None):
+        query = self.client.query(kind=PHASH)
+        if since is not None:
+            query.add_filter(CREATED, ">=", since)
+
+        return [int(x.key.name, 16) for x in query.fetch()]
+
+
+def bucket_name(resolution, start):
+    return f"{resolution}:{start:%Y%m%d%H}"
+
+
+def collect_deletes(futures, done):
+    """
+    Get the results of the completed delete calls, raising their errors
+    Args:
+        futures: the dict of the pending futures to their numbers of keys, which
+            the completed futures are removed from
+        done: the iterable of the completed futures
+
+    Returns:
+        The int of the number of deleted entities
+    """
+    num_deleted = 0
+    for future in done:
+        future.result()
+        num_deleted += futures.pop(future)
+
+    return num_deleted
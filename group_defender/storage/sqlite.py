@@ -0,0 +1,339 @@
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+
+from group_defender.constants import (
+    EXPIRY,
+    FILE_ID,
+    FILE_TYPE,
+    MSG_TEXT,
+    NUM_GROUPS,
+    NUM_USERS,
+    SWEEP_BATCH_SIZE,
+    TIMEOUT,
+    USERNAME,
+)
+from group_defender.storage.base import Storage, clamp_delta
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id INTEGER NOT NULL,
+    msg_id INTEGER NOT NULL,
+    username TEXT,
+    file_id TEXT,
+    file_type TEXT,
+    message_text TEXT,
+    expiry TEXT NOT NULL,
+    PRIMARY KEY (chat_id, msg_id)
+);
+CREATE INDEX IF NOT EXISTS messages_expiry ON messages (expiry);
+
+CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY);
+
+CREATE TABLE IF NOT EXISTS chat_stats (
+    chat_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS global_stats (
+    name TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS stats_buckets (
+    resolution TEXT NOT NULL,
+    start TEXT NOT NULL,
+    name TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    expiry TEXT,
+    PRIMARY KEY (resolution, start, name)
+);
+CREATE INDEX IF NOT EXISTS stats_buckets_expiry ON stats_buckets (expiry);
+
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value
+);
+
+CREATE TABLE IF NOT EXISTS api_counts (
+    name TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (name, year, month)
+);
+
+CREATE TABLE IF NOT EXISTS verdicts (
+    key TEXT PRIMARY KEY,
+    is_safe INTEGER NOT NULL,
+    likelihood TEXT,
+    expiry TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS verdicts_expiry ON verdicts (expiry);
+
+CREATE TABLE IF NOT EXISTS phashes (
+    hash TEXT PRIMARY KEY,
+    created TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS phashes_created ON phashes (created);
+"""
+EXPIRING_TABLES = ("messages", "verdicts", "stats_buckets")
+COUNTER_KEYS = {"chat_stats": "chat_id, name", "global_stats": "name"}
+
+
+class SQLiteStorage(Storage):
+    """
+    The storage backend on a local SQLite database in WAL mode, for single node
+    deployments and offline testing. Each thread has its own connection.
+    """
+
+    def __init__(self, file_name):
+        """
+        Args:
+            file_name: the string of the database file name
+        """
+        self.file_name = file_name
+        self._local = threading.local()
+
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.file_name, timeout=TIMEOUT, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        conn.execute("COMMIT")
+
+    def put_message(self, chat_id, msg_id, msg):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    chat_id,
+                    msg_id,
+                    msg[USERNAME],
+                    msg[FILE_ID],
+                    msg[FILE_TYPE],
+                    msg[MSG_TEXT],
+                    to_text(msg[EXPIRY]),
+                ),
+            )
+
+    def pop_message(self, chat_id, msg_id):
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT username, file_id, file_type, message_text FROM messages "
+                "WHERE chat_id = ? AND msg_id = ?",
+                (chat_id, msg_id),
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            conn.execute(
+                "DELETE FROM messages WHERE chat_id = ? AND msg_id = ?",
+                (chat_id, msg_id),
+            )
+
+        return dict(zip((USERNAME, FILE_ID, FILE_TYPE, MSG_TEXT), row))
+
+    def delete_expired(self, deadline):
+        conn = self._connect()
+        cutoff = to_text(datetime.utcnow())
+        num_deleted = 0
+
+        for table in EXPIRING_TABLES:
+            while True:
+                if time.monotonic() >= deadline:
+                    return num_deleted, True
+
+                num_rows = conn.execute(
+                    f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} "
+                    f"WHERE expiry < ? LIMIT ?)",
+                    (cutoff, SWEEP_BATCH_SIZE),
+                ).rowcount
+                num_deleted += num_rows
+
+                if num_rows < SWEEP_BATCH_SIZE:
+                    break
+
+        return num_deleted, False
+
+    def add_chat_stats(self, stats):
+        with self._transaction() as conn:
+            for chat_id, counts in stats.items():
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO chats VALUES (?)", (chat_id,)
+                )
+                if cursor.rowcount == 1:
+                    chat_count = NUM_USERS if chat_id > 0 else NUM_GROUPS
+                    add_counts(conn, "global_stats", (), {chat_count: 1})
+
+                add_counts(conn, "chat_stats", (chat_id,), counts)
+                add_counts(conn, "global_stats", (), counts)
+
+    def get_global_stats(self):
+        return dict(self._connect().execute("SELECT name, count FROM global_stats"))
+
+    def rebuild_global_stats(self):
+        with self._transaction() as conn:
+            counts = dict(
+                conn.execute(
+                    "SELECT name, SUM(count) FROM chat_stats GROUP BY name"
+                ).fetchall()
+            )
+            counts[NUM_USERS], counts[NUM_GROUPS] = conn.execute(
+                "SELECT COUNT(CASE WHEN chat_id > 0 THEN 1 END), "
+                "COUNT(CASE WHEN chat_id < 0 THEN 1 END) FROM chats"
+            ).fetchone()
+
+            conn.execute("DELETE FROM global_stats")
+            add_counts(conn, "global_stats", (), counts)
+
+        return counts
+
+    def add_stats_buckets(self, buckets):
+        with self._transaction() as conn:
+            for resolution, start, expiry, counts in buckets:
+                conn.executemany(
+                    "INSERT INTO stats_buckets VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (resolution, start, name) "
+                    "DO UPDATE SET count = count + excluded.count",
+                    [
+                        (resolution, to_text(start), name, count, to_text(expiry))
+                        for name, count in counts.items()
+                    ],
+                )
+
+    def get_stats_buckets(self, resolution, starts):
+        names = [to_text(x) for x in starts]
+        buckets = {x: {} for x in names}
+        params = ", ".join("?" * len(names))
+        rows = self._connect().execute(
+            f"SELECT start, name, count FROM stats_buckets "
+            f"WHERE resolution = ? AND start IN ({params})",
+            [resolution] + names,
+        )
+
+        for start, name, count in rows:
+            buckets[start][name] = count
+
+        return [buckets[x] for x in names]
+
+    def get_settings(self, names):
+        params = ", ".join("?" * len(names))
+        rows = self._connect().execute(
+            f"SELECT name, value FROM settings WHERE name IN ({params})", names
+        )
+        settings = dict(rows)
+
+        return [settings.get(x) for x in names]
+
+    def update_api_count(self, name, year, month, delta, limit):
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT count FROM api_counts "
+                "WHERE name = ? AND year = ? AND month = ?",
+                (name, year, month),
+            ).fetchone()
+            count = 0 if row is None else row[0]
+            delta = clamp_delta(count, delta, limit)
+
+            conn.execute(
+                "INSERT OR REPLACE INTO api_counts VALUES (?, ?, ?, ?)",
+                (name, year, month, count + delta),
+            )
+
+        return delta
+
+    def get_verdict(self, key):
+        row = (
+            self._connect()
+            .execute(
+                "SELECT is_safe, likelihood FROM verdicts WHERE key = ? AND expiry > ?",
+                (key, to_text(datetime.utcnow())),
+            )
+            .fetchone()
+        )
+
+        if row is None:
+            return None
+
+        return bool(row[0]), row[1]
+
+    def put_verdicts(self, keys, is_safe, likelihood, expiry):
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?)",
+                [(x, is_safe, likelihood, to_text(expiry)) for x in keys],
+            )
+
+    def add_phash(self, image_hash, created):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO phashes VALUES (?, ?)",
+                (f"{image_hash:016x}", to_text(created)),
+            )
+
+    def get_phashes(self, since=None):
+        conn = self._connect()
+        if since is None:
+            rows = conn.execute("SELECT hash FROM phashes")
+        else:
+            rows = conn.execute(
+                "SELECT hash FROM phashes WHERE created >= ?", (to_text(since),)
+            )
+
+        return [int(x, 16) for x, in rows]
+
+
+def add_counts(conn, table, key, counts):
+    """
+    Add the counts to the rows of a counter table in COUNTER_KEYS, which are keyed
+    by the key columns followed by the name
+    Args:
+        conn: the database connection
+        table: the string of the table name
+        key: the tuple of the values of the key columns before the name
+        counts: the dict of names to counts
+
+    Returns:
+        None
+    """
+    params = ", ".join("?" * (len(key) + 2))
+    conn.executemany(
+        f"INSERT INTO {table} VALUES ({params}) ON CONFLICT ({COUNTER_KEYS[table]}) "
+        f"DO UPDATE SET count = count + excluded.count",
+        [key + (name, count) for name, count in counts.items()],
+    )
+
+
+def to_text(value):
+    # Naive UTC datetimes with a fixed width so that they sort as text
+    if value is None:
+        return None
+
+    return value.isoformat(" ", "microseconds")
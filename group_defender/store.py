@@ -1,18 +1,21 @@
+import functools
 import secrets
+import time
 
 from datetime import datetime, timedelta
-from google.cloud import datastore
+from logbook import Logger
 from telegram import Chat, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import BadRequest
 
 from group_defender.constants import *
-
-datastore_client = datastore.Client()
+from group_defender.members import get_member_status
+from group_defender.outbox import RESTORE, outbox
+from group_defender.storage import storage
 
 
 def store_msg(chat_id, msg_id, username, file_id, file_type, msg_text):
     """
-    Store the message on datastore
+    Store the message so that it can be restored
     Args:
         chat_id: the int of the chat ID
         msg_id: the int of the message ID
@@ -24,18 +27,14 @@ def store_msg(chat_id, msg_id, username, file_id, file_type, msg_text):
     Returns:
         None
     """
-    msg_key = datastore_client.key(MSG, f"{chat_id},{msg_id}")
-    msg = datastore.Entity(msg_key)
-    msg.update(
-        {
-            USERNAME: username,
-            FILE_ID: file_id,
-            FILE_TYPE: file_type,
-            MSG_TEXT: msg_text,
-            EXPIRY: datetime.utcnow() + timedelta(days=MSG_LIFETIME),
-        }
-    )
-    datastore_client.put(msg)
+    msg = {
+        USERNAME: username,
+        FILE_ID: file_id,
+        FILE_TYPE: file_type,
+        MSG_TEXT: msg_text,
+        EXPIRY: datetime.utcnow() + timedelta(days=MSG_LIFETIME),
+    }
+    storage.put_message(chat_id, msg_id, msg)
 
 
 def process_msg(update, context):
@@ -52,18 +51,14 @@ def process_msg(update, context):
     chat_id = query.message.chat_id
     user_id = query.from_user.id
 
-    if query.message.chat.type in (
-        Chat.GROUP,
-        Chat.SUPERGROUP,
-    ) and context.bot.get_chat_member(chat_id, user_id).status not in (
-        ChatMember.ADMINISTRATOR,
-        ChatMember.CREATOR,
-    ):
-        context.bot.send_message(
-            user_id, "You can't perform this action as you're not a group admin."
-        )
+    if query.message.chat.type in (Chat.GROUP, Chat.SUPERGROUP):
+        status = get_member_status(context.bot, chat_id, user_id)
+        if status not in (ChatMember.ADMINISTRATOR, ChatMember.CREATOR):
+            context.bot.send_message(
+                user_id, "You can't perform this action as you're not a group admin."
+            )
 
-        return
+            return
 
     task, msg_id = query.data.split(",")
     msg_id = int(msg_id)
@@ -73,10 +68,7 @@ def process_msg(update, context):
             context.chat_data[chat_id, msg_id] = None
             restore_msg(context, query, chat_id, msg_id)
     elif task == DELETE:
-        try:
-            query.message.delete()
-        except BadRequest:
-            pass
+        outbox.delete_message(context.bot, chat_id, query.message.message_id)
 
 
 def restore_msg(context, query, chat_id, msg_id):
@@ -91,88 +83,175 @@ def restore_msg(context, query, chat_id, msg_id):
     Returns:
         None
     """
-    query.message.edit_text("Retrieving message")
-    msg_key = datastore_client.key(MSG, f"{chat_id},{msg_id}")
-    msg = datastore_client.get(msg_key)
+    # A notice of several deleted messages stays for the undo buttons of the others
+    undo_buttons = [
+        x
+        for row in query.message.reply_markup.inline_keyboard
+        for x in row
+        if (x.callback_data or "").startswith(f"{UNDO},")
+    ]
+    is_shared = len(undo_buttons) > 1
 
-    if msg is not None:
-        datastore_client.delete(msg_key)
+    if not is_shared:
+        query.message.edit_text("Retrieving message")
 
-        try:
-            query.message.delete()
-        except BadRequest:
-            return
+    msg = storage.pop_message(chat_id, msg_id)
 
-        file_id = msg[FILE_ID]
-        file_type = msg[FILE_TYPE]
-        username = msg[USERNAME]
-        msg_text = msg[MSG_TEXT]
-
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    text="Delete (Cannot be undone)", callback_data=f"{DELETE},{msg_id}"
-                )
-            ]
-        ]
-        if secrets.randbelow(2):
-            keyboard.append(
-                [InlineKeyboardButton("Support Group Defender", callback_data=PAYMENT)]
-            )
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        if file_id is not None:
-            caption = f"@{username} sent this."
-            if file_type == PHOTO:
-                context.bot.send_photo(
-                    chat_id, file_id, caption=caption, reply_markup=reply_markup
-                )
-            elif file_type == AUDIO:
-                context.bot.send_audio(
-                    chat_id, file_id, caption=caption, reply_markup=reply_markup
-                )
-            elif file_type == VIDEO:
-                context.bot.send_video(
-                    chat_id, file_id, caption=caption, reply_markup=reply_markup
-                )
-            elif file_type == DOCUMENT:
-                context.bot.send_document(
-                    chat_id, file_id, caption=caption, reply_markup=reply_markup
-                )
-            elif file_type == ANIMATION:
-                context.bot.send_animation(
-                    chat_id, file_id, caption=caption, reply_markup=reply_markup
-                )
+    if msg is not None:
+        if is_shared:
+            remove_undo_button(query, msg_id)
+            send_restored_msg(context.bot, chat_id, msg_id, msg)
         else:
-            context.bot.send_message(
+            # Only restore it once the notice is gone, the undo button stays
+            # guarded until then
+            outbox.delete_message(
+                context.bot,
                 chat_id,
-                f"@{username} sent this:\n{msg_text}",
-                reply_markup=reply_markup,
+                query.message.message_id,
+                callback=functools.partial(
+                    finish_restore, context.bot, context.chat_data, chat_id, msg_id, msg
+                ),
             )
+
+            return
+    elif is_shared:
+        remove_undo_button(query, msg_id)
     else:
         try:
             query.message.edit_text("Message has expired")
         except BadRequest:
             pass
 
+    context.chat_data.pop((chat_id, msg_id), None)
+
+
+def remove_undo_button(query, msg_id):
+    """
+    Remove the undo button of a message from a notice of several deleted messages
+    Args:
+        query: the query object
+        msg_id: the int of the message ID
+
+    Returns:
+        None
+    """
+    keyboard = [
+        [x for x in row if x.callback_data != f"{UNDO},{msg_id}"]
+        for row in query.message.reply_markup.inline_keyboard
+    ]
+
     try:
-        del context.chat_data[chat_id, msg_id]
-    except KeyError:
+        query.message.edit_reply_markup(
+            InlineKeyboardMarkup([x for x in keyboard if x])
+        )
+    except BadRequest:
         pass
 
 
+def finish_restore(bot, chat_data, chat_id, msg_id, msg, _, error):
+    """
+    Restore the message once its notice has been deleted, and release the guard of
+    its undo button
+    Args:
+        bot: the bot object
+        chat_data: the dict of the chat data holding the guard
+        chat_id: the int of the chat ID
+        msg_id: the int of the message ID
+        msg: the dict of the stored message
+        _: the result of deleting the notice
+        error: the error of deleting the notice
+
+    Returns:
+        None
+    """
+    try:
+        if error is None:
+            send_restored_msg(bot, chat_id, msg_id, msg)
+        else:
+            # The notice is still there, so keep the message for another undo
+            Logger().error(
+                f"Failed to delete the notice of message {msg_id} in chat {chat_id}: "
+                f"{error}"
+            )
+            storage.put_message(chat_id, msg_id, msg)
+    finally:
+        chat_data.pop((chat_id, msg_id), None)
+
+
+def send_restored_msg(bot, chat_id, msg_id, msg):
+    """
+    Queue the message to be sent again on behalf of its sender
+    Args:
+        bot: the bot object
+        chat_id: the int of the chat ID
+        msg_id: the int of the message ID
+        msg: the dict of the stored message
+
+    Returns:
+        None
+    """
+    file_id = msg[FILE_ID]
+    file_type = msg[FILE_TYPE]
+    username = msg[USERNAME]
+    msg_text = msg[MSG_TEXT]
+
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                text="Delete (Cannot be undone)", callback_data=f"{DELETE},{msg_id}"
+            )
+        ]
+    ]
+    if secrets.randbelow(2):
+        keyboard.append(
+            [InlineKeyboardButton("Support Group Defender", callback_data=PAYMENT)]
+        )
+
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    if file_id is not None:
+        send_funcs = {
+            PHOTO: bot.send_photo,
+            AUDIO: bot.send_audio,
+            VIDEO: bot.send_video,
+            DOCUMENT: bot.send_document,
+            ANIMATION: bot.send_animation,
+        }
+        if file_type in send_funcs:
+            outbox.submit(
+                RESTORE,
+                chat_id,
+                send_funcs[file_type],
+                chat_id,
+                file_id,
+                caption=f"@{username} sent this.",
+                reply_markup=reply_markup,
+            )
+    else:
+        outbox.submit(
+            RESTORE,
+            chat_id,
+            bot.send_message,
+            chat_id,
+            f"@{username} sent this:\n{msg_text}",
+            reply_markup=reply_markup,
+        )
+
+
 def delete_expired_msg(_):
     """
-    Delete expired message
+    Delete expired messages, cached verdicts and fine-grained stats buckets, stopping
+    after SWEEP_DEADLINE and resuming from there on the next run
     Args:
         _: unused variable
 
     Returns:
         None
     """
-    query = datastore_client.query(kind=MSG)
-    query.add_filter(EXPIRY, "<", datetime.utcnow())
-    query.keys_only()
-    keys = [x.key for x in query.fetch()]
-    datastore_client.delete_multi(keys)
+    start = time.monotonic()
+    num_deleted, has_more = storage.delete_expired(start + SWEEP_DEADLINE)
+
+    Logger().info(
+        f"Deleted {num_deleted} expired entities in {time.monotonic() - start:.1f}s"
+        f'{", more left" if has_more else ""}'
+    )
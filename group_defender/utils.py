@@ -1,26 +1,24 @@
+import functools
 import secrets
 
+from logbook import Logger
 from telegram import ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import BadRequest
 from telegram.ext import ConversationHandler
 from telegram.ext.dispatcher import run_async
 
-from group_defender.constants import UNDO, SETTING, VALUE, PAYMENT
+from group_defender.cache import TTLCache
+from group_defender.constants import (
+    UNDO,
+    PAYMENT,
+    CHEAP_NOTICE_CACHE_SIZE,
+    CHEAP_NOTICE_INTERVAL,
+    URL,
+)
+from group_defender.outbox import NOTICE, outbox
 from group_defender.store import store_msg
-from group_defender.store import datastore_client
 
-
-def get_setting(name):
-    return get_settings([name])[0]
-
-
-def get_settings(names):
-    values = []
-    for name in names:
-        key = datastore_client.key(SETTING, name)
-        values.append(datastore_client.get(key)[VALUE])
-
-    return values
+cheap_notices = TTLCache(CHEAP_NOTICE_CACHE_SIZE, CHEAP_NOTICE_INTERVAL)
 
 
 @run_async
@@ -43,7 +41,7 @@ def cancel(update, _):
 
 def filter_msg(update, context, file_id, file_type, text):
     """
-    Delete and send new message
+    Delete the message and send a notice with an undo button once it is deleted
     Args:
         update: the update object
         context: the context object
@@ -60,22 +58,113 @@ def filter_msg(update, context, file_id, file_type, text):
     store_msg(
         chat_id, msg_id, message.from_user.username, file_id, file_type, message.text
     )
+    outbox.delete_message(
+        context.bot,
+        chat_id,
+        msg_id,
+        callback=functools.partial(notify_deleted, context.bot, message, text),
+    )
+
+
+def notify_deleted(bot, message, text, _, error):
+    """
+    Send the notice of a deleted message, or ask for the permission to delete
+    messages if the deletion failed
+    Args:
+        bot: the bot object
+        message: the message object of the deleted message
+        text: the string of the notice
+        _: the result of the deletion
+        error: the error of the deletion, None if it was deleted
+
+    Returns:
+        None
+    """
+    if error is None:
+        outbox.send_notice(
+            bot, message.chat_id, (message.message_id, text), send_deleted_notices
+        )
+    elif isinstance(error, BadRequest):
+        outbox.submit(
+            NOTICE,
+            message.chat_id,
+            message.reply_text,
+            "I was not able to delete this unsafe message.\n\n"
+            'Go to group admin settings and ensure that "Delete Messages" is on for me.',
+        )
+    else:
+        Logger().error(f"Failed to delete message in chat {message.chat_id}: {error}")
+
+
+def send_deleted_notices(bot, chat_id, notices):
+    """
+    Send the notices of the deleted messages of a chat in one message, with an undo
+    button for each of them
+    Args:
+        bot: the bot object
+        chat_id: the int of the chat ID
+        notices: the list of tuples of the message ID and the notice
 
-    try:
-        message.delete()
+    Returns:
+        None
+    """
+    if len(notices) == 1:
+        msg_id, text = notices[0]
         keyboard = [
             [InlineKeyboardButton(text="Undo", callback_data=f"{UNDO},{msg_id}")]
         ]
+    else:
+        text = "\n\n".join(f"{i}. {x}" for i, (_, x) in enumerate(notices, 1))
+        buttons = [
+            InlineKeyboardButton(text=f"Undo {i}", callback_data=f"{UNDO},{msg_id}")
+            for i, (msg_id, _) in enumerate(notices, 1)
+        ]
+        keyboard = [buttons[i : i + 5] for i in range(0, len(buttons), 5)]
 
-        if secrets.randbelow(2):
-            keyboard.append(
-                [InlineKeyboardButton("Support Group Defender", callback_data=PAYMENT)]
-            )
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(chat_id, text, reply_markup=reply_markup)
-    except BadRequest:
-        message.reply_text(
-            "I was not able to delete this unsafe message.\n\n"
-            'Go to group admin settings and ensure that "Delete Messages" is on for me.'
+    if secrets.randbelow(2):
+        keyboard.append(
+            [InlineKeyboardButton("Support Group Defender", callback_data=PAYMENT)]
         )
+
+    bot.send_message(chat_id, text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+def describe_file(file_type):
+    """
+    Describe a file of the type in a message, with its article
+    Args:
+        file_type: the string of the file type
+
+    Returns:
+        The string of the description
+    """
+    if file_type == URL:
+        return "a message with a link"
+
+    article = "an" if file_type[0] in "aeiou" else "a"
+
+    return f"{article} {file_type}"
+
+
+def send_cheap_notice(update):
+    """
+    Let the chat know that it is sending more than the bot can fully check, at most
+    once every notice interval
+    Args:
+        update: the update object
+
+    Returns:
+        None
+    """
+    chat = update.effective_chat
+    if cheap_notices.get(chat.id) is not None:
+        return
+
+    cheap_notices.set(chat.id, True)
+    outbox.submit(
+        NOTICE,
+        chat.id,
+        chat.send_message,
+        "There are too many files and links here for me to fully check right now, "
+        "so I'm only running quick checks until things calm down.",
+    )
@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# Keep the package import from connecting to Datastore
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault(
+    "SQLITE_DB", os.path.join(tempfile.gettempdir(), "group_defender_test.db")
+)
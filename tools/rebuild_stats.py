@@ -0,0 +1,22 @@
+"""
+Recompute the global stats rollup from the stats of all the chats. Run it while the bot
+is stopped, e.g. after the rollup was first introduced or if it has drifted:
+
+    python tools/rebuild_stats.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from group_defender.stats import rebuild_global_stats
+
+
+def main():
+    counts = rebuild_global_stats()
+    for name, count in sorted(counts.items()):
+        print(f"{name}: {count}")
+
+
+if __name__ == "__main__":
+    main()
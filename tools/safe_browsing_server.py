@@ -0,0 +1,147 @@
+"""
+A local stand-in for the Safe Browsing Update API, for testing the local hash
+prefix database offline.
+
+The unsafe url expressions are read from a file, one per line in the form of
+"expression [threat type]", e.g. "evil.example.com/" or "evil.example.com/a/ MALWARE".
+The file is re-read on every update request so that editing it produces partial
+updates. Point the bot at the server with:
+
+    SAFE_BROWSING_DB=/tmp/sb SAFE_BROWSING_API=http://localhost:8000/v4 python bot.py
+"""
+import argparse
+import base64
+import hashlib
+import json
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX_SIZE = 4
+MINIMUM_WAIT = "5s"
+history = {}
+
+
+def read_full_hashes(file_name):
+    full_hashes = {}
+    with open(file_name) as f:
+        for line in f:
+            parts = line.split()
+            if parts:
+                threat_type = parts[1] if len(parts) > 1 else "MALWARE"
+                full_hash = hashlib.sha256(parts[0].encode()).digest()
+                full_hashes.setdefault(threat_type, set()).add(full_hash)
+
+    return full_hashes
+
+
+def list_update(threat_type, full_hashes, state):
+    prefixes = sorted({x[:PREFIX_SIZE] for x in full_hashes})
+    new_state = hashlib.sha256(threat_type.encode() + b"".join(prefixes)).hexdigest()
+    history[new_state] = prefixes
+    response = {
+        "threatType": threat_type,
+        "platformType": "ANY_PLATFORM",
+        "threatEntryType": "URL",
+        "newClientState": new_state,
+        "checksum": {
+            "sha256": base64.b64encode(
+                hashlib.sha256(b"".join(prefixes)).digest()
+            ).decode()
+        },
+    }
+
+    if state in history:
+        old = history[state]
+        old_set, new_set = set(old), set(prefixes)
+        response["responseType"] = "PARTIAL_UPDATE"
+        response["removals"] = [
+            {
+                "compressionType": "RAW",
+                "rawIndices": {
+                    "indices": [i for i, x in enumerate(old) if x not in new_set]
+                },
+            }
+        ]
+        additions = [x for x in prefixes if x not in old_set]
+    else:
+        response["responseType"] = "FULL_UPDATE"
+        additions = prefixes
+
+    response["additions"] = [
+        {
+            "compressionType": "RAW",
+            "rawHashes": {
+                "prefixSize": PREFIX_SIZE,
+                "rawHashes": base64.b64encode(b"".join(additions)).decode(),
+            },
+        }
+    ]
+
+    return response
+
+
+class Handler(BaseHTTPRequestHandler):
+    file_name = None
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        full_hashes = read_full_hashes(self.file_name)
+
+        if self.path.startswith("/v4/threatListUpdates:fetch"):
+            result = {
+                "listUpdateResponses": [
+                    list_update(
+                        x["threatType"],
+                        full_hashes.get(x["threatType"], set()),
+                        x["state"],
+                    )
+                    for x in body["listUpdateRequests"]
+                ],
+                "minimumWaitDuration": MINIMUM_WAIT,
+            }
+        elif self.path.startswith("/v4/fullHashes:find"):
+            prefixes = [
+                base64.b64decode(x["hash"]) for x in body["threatInfo"]["threatEntries"]
+            ]
+            result = {
+                "matches": [
+                    {
+                        "threatType": threat_type,
+                        "platformType": "ANY_PLATFORM",
+                        "threatEntryType": "URL",
+                        "threat": {"hash": base64.b64encode(full_hash).decode()},
+                        "cacheDuration": "300s",
+                    }
+                    for threat_type, hashes in full_hashes.items()
+                    for full_hash in hashes
+                    if any(full_hash.startswith(x) for x in prefixes)
+                ],
+                "negativeCacheDuration": "300s",
+            }
+        else:
+            self.send_error(404)
+
+            return
+
+        data = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("file_name", help="the file of unsafe url expressions")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    Handler.file_name = args.file_name
+    server = ThreadingHTTPServer(("localhost", args.port), Handler)
+    print(f"Serving on http://localhost:{args.port}/v4")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()